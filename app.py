@@ -8,9 +8,9 @@ spec = importlib.util.spec_from_file_location('hospital_main_app', source_path)
 module = importlib.util.module_from_spec(spec)
 spec.loader.exec_module(module)
 
-# Ensure the application's database and migrations are initialized when imported
+# Ensure the application's database(s) and migrations are initialized when imported
 try:
-	_init = getattr(module, 'init_db', None)
+	_init = getattr(module, 'init_all_databases', None) or getattr(module, 'init_db', None)
 	if callable(_init):
 		_init()
 except Exception:
@@ -44,7 +44,7 @@ except Exception:
 if __name__ == '__main__':
 	# convenience: allow `python app.py` to start the dev server for local testing
 	try:
-		_init = getattr(module, 'init_db', None)
+		_init = getattr(module, 'init_all_databases', None) or getattr(module, 'init_db', None)
 		if callable(_init):
 			_init()
 	except Exception:
@@ -0,0 +1,141 @@
+"""Writer latency with and without heavy reporting load.
+
+Runs the same front-desk write mix four times against a scratch database:
+  1. writers only
+  2. writers + reporting processes reading the primary hospital.db
+  3. writers + reporting processes routed to the read-only snapshot
+  4. the same, with the snapshot rebuilt back to back while the writers run
+
+Reporters run in separate processes, like reports served by other gunicorn
+workers, so the numbers show database lock contention rather than the GIL.
+
+Usage: python bench_reporting.py [--seconds 5] [--writers 4] [--reporters 4]
+"""
+import argparse
+import importlib.util
+import io
+import multiprocessing
+import os
+import random
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+
+base = os.path.dirname(os.path.abspath(__file__))
+source_path = os.path.join(base, 'main folder', 'app.py')
+spec = importlib.util.spec_from_file_location('hospital_main_app', source_path)
+module = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(module)
+
+
+def seed(patients, invoices):
+    conn = sqlite3.connect(module.DATABASE)
+    conn.executemany('INSERT INTO patients (name, age, gender, disease) VALUES (?, ?, ?, ?)',
+                     ((f'Patient {i}', i % 90, 'F' if i % 2 else 'M', 'Checkup') for i in range(patients)))
+    conn.executemany('INSERT INTO invoices (patient_id, amount, status, description, created_at, due_date) '
+                     'VALUES (?, ?, ?, ?, datetime("now"), ?)',
+                     ((random.randint(1, patients), random.uniform(10, 500), random.choice(['Paid', 'Unpaid']),
+                       'Consultation', '2030-01-01') for _ in range(invoices)))
+    conn.commit()
+    conn.close()
+
+
+def writer(stop, latencies, invoice_count):
+    while not stop.is_set():
+        started = time.perf_counter()
+        if random.random() < 0.5:
+            module.execute_write('INSERT INTO patients (name, age, gender, disease) VALUES (?, ?, ?, ?)',
+                                 ('Walk-in', 40, 'F', 'Flu'))
+        else:
+            module.execute_write("UPDATE invoices SET status='Paid' WHERE id = ?",
+                                 (random.randint(1, invoice_count),))
+        latencies.append((time.perf_counter() - started) * 1000.0)
+
+
+@module.reporting_read
+def reporting_pass():
+    module.report_totals()
+    module.write_invoices_csv(io.StringIO())
+
+
+def reporter(stop, counter, database, snapshot_path, use_snapshot):
+    module.DATABASE = database
+    module.REPORTING_SNAPSHOT = use_snapshot
+    module.reporting_snapshots[module.current_tenant()] = module.ReportingSnapshot(
+        snapshot_path, database, refresh_seconds=3600)
+    while not stop.is_set():
+        reporting_pass()
+        with counter.get_lock():
+            counter.value += 1
+
+
+def refresher(stop, refresh_ms):
+    snapshot = module.get_reporting_snapshot()
+    while not stop.is_set():
+        started = time.perf_counter()
+        if snapshot.refresh():
+            refresh_ms.append((time.perf_counter() - started) * 1000.0)
+
+
+def run(label, seconds, writers, reporters, invoice_count, use_snapshot=False, refresh=False):
+    stop = threading.Event()
+    proc_stop = multiprocessing.Event()
+    reports = multiprocessing.Value('i', 0)
+    latencies = []
+    procs = [multiprocessing.Process(target=reporter, args=(proc_stop, reports, module.DATABASE,
+                                                            module.get_reporting_snapshot().path, use_snapshot))
+             for _ in range(reporters)]
+    for p in procs:
+        p.start()
+    refresh_ms = []
+    threads = [threading.Thread(target=writer, args=(stop, latencies, invoice_count)) for _ in range(writers)]
+    if refresh:
+        threads.append(threading.Thread(target=refresher, args=(stop, refresh_ms)))
+    for t in threads:
+        t.start()
+    time.sleep(seconds)
+    stop.set()
+    for t in threads:
+        t.join()
+    proc_stop.set()
+    for p in procs:
+        p.join()
+    print(f'{label:<32} writes={len(latencies):>6}  p50={module._percentile(latencies, 50):8.2f} ms  '
+          f'p99={module._percentile(latencies, 99):8.2f} ms  reports={reports.value}')
+    if refresh:
+        print(f'{"":<32} refreshes={len(refresh_ms)}  p50={module._percentile(refresh_ms, 50):8.2f} ms  '
+              f'max={max(refresh_ms, default=0):8.2f} ms')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--seconds', type=float, default=5)
+    parser.add_argument('--writers', type=int, default=4)
+    parser.add_argument('--reporters', type=int, default=4)
+    parser.add_argument('--patients', type=int, default=20000)
+    parser.add_argument('--invoices', type=int, default=100000)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='hospital-bench-')
+    try:
+        module.DATABASE = os.path.join(workdir, 'hospital.db')
+        module.init_db()
+        seed(args.patients, args.invoices)
+        snapshot = module.ReportingSnapshot(os.path.join(workdir, 'snapshot.db'), module.DATABASE, refresh_seconds=3600)
+        module.reporting_snapshots[module.current_tenant()] = snapshot
+        snapshot.refresh()
+
+        run('writers only', args.seconds, args.writers, 0, args.invoices)
+        run('writers + reports on primary', args.seconds, args.writers, args.reporters, args.invoices)
+        run('writers + reports on snapshot', args.seconds, args.writers, args.reporters, args.invoices,
+            use_snapshot=True)
+        run('writers + snapshot refreshes', args.seconds, args.writers, args.reporters, args.invoices,
+            use_snapshot=True, refresh=True)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
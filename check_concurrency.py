@@ -0,0 +1,207 @@
+"""Checks for the connection pool's hard cap and the write queue's savepoints.
+
+Runs against scratch branch databases in a temporary folder:
+  1. threads reading and writing across three branches never hold more than
+     MAX_OPEN_CONNECTIONS SQLite handles at once (counted as they are opened/closed)
+  2. in a batch committed by the write queue, a failing write fails only its own
+     caller: the other writes in the batch commit, and a failing multi-statement
+     write leaves none of its statements behind
+  3. a write to a branch file that cannot be opened raises instead of hanging
+  4. signing in with a branch on the login form wins over the branch in the session
+
+Exits non-zero if any check fails.
+
+Usage: python check_concurrency.py [--threads 16] [--iterations 200] [--max-open 4]
+"""
+import argparse
+import importlib.util
+import os
+import random
+import shutil
+import sqlite3
+import sys
+import tempfile
+import threading
+import types
+
+parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+parser.add_argument('--threads', type=int, default=16)
+parser.add_argument('--iterations', type=int, default=200)
+parser.add_argument('--max-open', type=int, default=4)
+args = parser.parse_args()
+
+# the module reads its settings at import time
+BRANCHES = ('north', 'south', 'east')
+os.environ.update({
+    'TENANTS': ','.join(BRANCHES),
+    'MAX_OPEN_CONNECTIONS': str(args.max_open),
+    'CONNECTION_WAIT_SECONDS': '10',
+    'WRITE_QUEUE': '1',
+    'JOB_WORKERS': '0',
+})
+workdir = tempfile.mkdtemp(prefix='hospital-check-')
+base = os.path.dirname(os.path.abspath(__file__))
+source_path = os.path.join(base, 'main folder', 'app.py')
+os.chdir(workdir)
+spec = importlib.util.spec_from_file_location('hospital_main_app', source_path)
+module = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(module)
+
+
+class CountedConnection(sqlite3.Connection):
+    """Counts the app's open handles independently of the pool's own bookkeeping."""
+    lock = threading.Lock()
+    live = 0
+    peak = 0
+
+    def __init__(self, *a, **kw):
+        super().__init__(*a, **kw)
+        self._counted = True
+        with CountedConnection.lock:
+            CountedConnection.live += 1
+            CountedConnection.peak = max(CountedConnection.peak, CountedConnection.live)
+
+    def close(self):
+        with CountedConnection.lock:
+            if self._counted:
+                self._counted = False
+                CountedConnection.live -= 1
+        super().close()
+
+
+def counted_connect(*a, **kw):
+    return sqlite3.connect(*a, factory=CountedConnection, **kw)
+
+
+# only the app module's connections are counted; sqlite3 itself is left alone
+module.sqlite3 = types.SimpleNamespace(**{**vars(sqlite3), 'connect': counted_connect})
+
+failures = []
+
+
+def check(label, ok, detail=''):
+    print(f'{label:<48} {"ok" if ok else "FAILED"}  {detail}')
+    if not ok:
+        failures.append(label)
+
+
+def mixed_load(errors):
+    try:
+        for _ in range(args.iterations):
+            with module.use_tenant(random.choice(BRANCHES)):
+                step = random.random()
+                if step < 0.4:
+                    module.db_queries.scalar('patients.count')
+                elif step < 0.6:
+                    with module.read_connection(archive=True) as conn:
+                        module.db_queries.all('invoices.export', conn=conn)
+                else:
+                    module.db_queries.write('patients.insert', ('Load', 40, 'F', 'Flu'))
+    except Exception as e:
+        errors.append(e)
+
+
+def check_pool_cap():
+    errors = []
+    threads = [threading.Thread(target=mixed_load, args=(errors,)) for _ in range(args.threads)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    stats = module.connection_pool.stats()
+    check('load finished without errors', not errors, repr(errors[:1]) if errors else '')
+    check(f'open handles never above {args.max_open}', CountedConnection.peak <= args.max_open,
+          f'peak={CountedConnection.peak} evicted={stats["evicted"]} waits={stats["waits"]}')
+    check('pool count matches handles really open', stats['open'] == CountedConnection.live,
+          f'pool={stats["open"]} live={CountedConnection.live}')
+
+
+def check_savepoints():
+    barrier = threading.Barrier(args.threads)
+    outcomes = {}
+
+    def submit(i):
+        with module.use_tenant('south'):
+            barrier.wait()
+            try:
+                if i % 3 == 0:
+                    # second statement violates NOT NULL: the first must be rolled back with it
+                    module.execute_writes([('INSERT INTO patients (name) VALUES (?)', (f'half-{i}',)),
+                                           ('INSERT INTO patients (name) VALUES (NULL)', ())])
+                else:
+                    module.execute_write('INSERT INTO patients (name) VALUES (?)', (f'ok-{i}',))
+                outcomes[i] = 'committed'
+            except sqlite3.IntegrityError:
+                outcomes[i] = 'failed'
+
+    before = module.write_queue.metrics()['batch_size']['max']
+    threads = [threading.Thread(target=submit, args=(i,)) for i in range(args.threads)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    conn = sqlite3.connect(module.tenant_database('south'))
+    names = {r[0] for r in conn.execute("SELECT name FROM patients WHERE name LIKE 'ok-%' OR name LIKE 'half-%'")}
+    conn.close()
+    expected_ok = {f'ok-{i}' for i in range(args.threads) if i % 3}
+    batched = max(before, module.write_queue.metrics()['batch_size']['max'])
+    check('writes were group-committed', batched > 1, f'largest batch={batched}')
+    check('only the failing writes raised',
+          all(outcomes.get(i) == ('failed' if i % 3 == 0 else 'committed') for i in range(args.threads)))
+    check('other writes in the batch committed', names >= expected_ok, f'{len(names & expected_ok)}/{len(expected_ok)}')
+    check('failed writes left nothing behind', not any(n.startswith('half-') for n in names))
+
+
+def check_unopenable_writer():
+    result = []
+
+    def write():
+        with module.use_tenant('missing/branch'):
+            try:
+                module.execute_write('INSERT INTO patients (name) VALUES (?)', ('lost',))
+                result.append('committed')
+            except sqlite3.Error as e:
+                result.append(e)
+
+    t = threading.Thread(target=write, daemon=True)
+    t.start()
+    t.join(15)
+    check('write to an unopenable file raises', not t.is_alive() and result and isinstance(result[0], sqlite3.Error),
+          'still waiting' if t.is_alive() else repr(result[:1]))
+    try:
+        with module.use_tenant('north'):
+            module.execute_write('INSERT INTO patients (name) VALUES (?)', ('after',))
+        error = None
+    except Exception as e:
+        error = e
+    check('write queue still works afterwards', error is None, repr(error) if error else '')
+
+
+def check_login_branch():
+    client = module.app.test_client()
+    client.post('/login', data={'username': 'admin', 'password': 'password', 'tenant': 'south'})
+    client.post('/login', data={'username': 'admin', 'password': 'password', 'tenant': 'east'})
+    with client.session_transaction() as session:
+        tenant = session.get('tenant')
+    check('login form branch beats the session branch', tenant == 'east', f'session tenant={tenant}')
+
+
+def main():
+    try:
+        for branch in BRANCHES:
+            with module.use_tenant(branch):
+                module.init_db()
+        check_pool_cap()
+        check_savepoints()
+        check_unopenable_writer()
+        check_login_branch()
+    finally:
+        os.chdir(base)
+        shutil.rmtree(workdir, ignore_errors=True)
+    if failures:
+        print(f'{len(failures)} check(s) failed')
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
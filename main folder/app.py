@@ -1,8 +1,15 @@
 import os
 import sqlite3
 import csv
-from io import StringIO
-from flask import Flask, render_template, request, redirect, url_for, session, flash, Response
+import json
+import queue
+import threading
+import time
+import uuid
+from collections import OrderedDict, deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from flask import Flask, render_template, request, redirect, url_for, session, flash, Response, jsonify, send_file, g, has_request_context
 from werkzeug.security import generate_password_hash, check_password_hash
 from flask_login import LoginManager, UserMixin, login_user, logout_user, login_required, current_user
 from functools import wraps
@@ -13,6 +20,78 @@ app.secret_key = os.environ.get('SECRET_KEY', 'dev-key-change-in-production')
 
 DATABASE = 'hospital.db'
 COUNT_DOCTORS_QUERY = 'SELECT COUNT(*) FROM doctors'
+# per-connection prepared statement cache (sqlite3 default is 128); see QueryRegistry
+SQLITE_CACHED_STATEMENTS = int(os.environ.get('SQLITE_CACHED_STATEMENTS', '256'))
+
+# Multi-branch mode: TENANTS="north,south" gives each branch its own database file.
+# Unset, the app runs single-branch on DATABASE exactly as before.
+TENANTS = [t.strip() for t in os.environ.get('TENANTS', '').split(',') if t.strip()]
+TENANT_DB_TEMPLATE = os.environ.get('TENANT_DB_TEMPLATE', 'hospital_{tenant}.db')
+DEFAULT_TENANT = os.environ.get('DEFAULT_TENANT', TENANTS[0] if TENANTS else 'default')
+# hard cap on open SQLite handles (reads, archive, writer, snapshot) across all branch files;
+# least recently used idle handles are closed first, and callers wait when all are busy
+MAX_OPEN_CONNECTIONS = int(os.environ.get('MAX_OPEN_CONNECTIONS', '32'))
+CONNECTION_WAIT_SECONDS = float(os.environ.get('CONNECTION_WAIT_SECONDS', '30'))
+TENANT_WORKERS = int(os.environ.get('TENANT_WORKERS', '4'))
+
+# Optional write-queue mode: one writer thread per process group-commits mutations
+WRITE_QUEUE_ENABLED = os.environ.get('WRITE_QUEUE', '0') == '1'
+WRITE_BATCH_MAX = int(os.environ.get('WRITE_BATCH_MAX', '64'))
+WRITE_BATCH_WINDOW_MS = float(os.environ.get('WRITE_BATCH_WINDOW_MS', '5'))
+
+# Background jobs (exports, reports, scheduled maintenance); JOB_WORKERS=0 disables the runner
+JOB_WORKERS = int(os.environ.get('JOB_WORKERS', '2'))
+JOB_POLL_SECONDS = float(os.environ.get('JOB_POLL_SECONDS', '1'))
+# a running job refreshes heartbeat_at this often; one silent for JOB_STALE_SECONDS is requeued
+JOB_HEARTBEAT_SECONDS = float(os.environ.get('JOB_HEARTBEAT_SECONDS', '30'))
+JOB_STALE_SECONDS = int(os.environ.get('JOB_STALE_SECONDS', '900'))
+EXPORT_DIR = os.environ.get('EXPORT_DIR', 'exports')
+EXPORT_RETENTION_DAYS = int(os.environ.get('EXPORT_RETENTION_DAYS', '7'))
+
+# Reporting mode: analytical reads go to a periodically refreshed read-only snapshot
+REPORTING_SNAPSHOT = os.environ.get('REPORTING_SNAPSHOT', '0') == '1'
+SNAPSHOT_PATH = os.environ.get('SNAPSHOT_PATH', 'hospital_snapshot.db')
+SNAPSHOT_REFRESH_SECONDS = int(os.environ.get('SNAPSHOT_REFRESH_SECONDS', '60'))
+# a copy still waiting for the source lock after this long is abandoned (and logged)
+SNAPSHOT_REFRESH_TIMEOUT = float(os.environ.get('SNAPSHOT_REFRESH_TIMEOUT', '30'))
+
+# Live dashboard: one changelog poller per process fans updates out to all SSE clients
+DASHBOARD_POLL_SECONDS = float(os.environ.get('DASHBOARD_POLL_SECONDS', '1'))
+DASHBOARD_STREAM_SECONDS = int(os.environ.get('DASHBOARD_STREAM_SECONDS', '300'))
+# each open stream pins a server thread; keep this below gunicorn's --threads (see Procfile)
+DASHBOARD_MAX_STREAMS = int(os.environ.get('DASHBOARD_MAX_STREAMS', '4'))
+DASHBOARD_BUSY_RETRY_MS = 15000
+DASHBOARD_CLIENT_BUFFER = 100
+# a bigger changelog backlog than this (e.g. after a bulk import) is skipped: totals are republished instead
+DASHBOARD_CHANGELOG_LIMIT = int(os.environ.get('DASHBOARD_CHANGELOG_LIMIT', '1000'))
+CHANGELOG_TABLES = ('patients', 'doctors', 'appointments', 'invoices')
+CHANGELOG_RETENTION = '-1 day'
+
+# Soft delete + history; closed appointments and paid invoices move to an attached archive DB
+SOFT_DELETE_TABLES = ('patients', 'doctors', 'invoices')
+HISTORY_COLUMNS = {
+    'patients': ('name', 'age', 'gender', 'disease', 'deleted_at'),
+    'doctors': ('name', 'specialty', 'phone', 'email', 'fee', 'deleted_at'),
+    'appointments': ('patient_id', 'doctor_id', 'date', 'time', 'status', 'notes'),
+    'invoices': ('patient_id', 'amount', 'status', 'description', 'created_at', 'due_date', 'deleted_at'),
+}
+ARCHIVE_DATABASE = os.environ.get('ARCHIVE_DATABASE', 'hospital_archive.db')
+ARCHIVE_AFTER_MONTHS = int(os.environ.get('ARCHIVE_AFTER_MONTHS', '12'))
+ARCHIVE_BATCH_SIZE = 500
+ARCHIVE_COLUMNS = {
+    'appointments': ('id', 'patient_id', 'doctor_id', 'date', 'time', 'status', 'notes'),
+    'invoices': ('id', 'patient_id', 'amount', 'status', 'description', 'created_at', 'due_date', 'deleted_at'),
+}
+# rows matching these (with the cutoff date bound to ?) are closed and old enough to archive
+ARCHIVE_RULES = {
+    'appointments': "status IN ('Cancelled', 'Completed') AND date < date('now', ?)",
+    'invoices': "status = 'Paid' AND created_at < date('now', ?)",
+}
+# what archive_totals.amount adds up per table (report_totals' archived revenue), so totals never scan the archive
+ARCHIVE_TOTALS = {
+    'appointments': '0',
+    'invoices': 'CASE WHEN deleted_at IS NULL THEN amount ELSE 0 END',
+}
 
 # Flask-Login setup + simple User wrapper
 login_manager = LoginManager()
@@ -27,18 +106,17 @@ class User(UserMixin):
 
     @staticmethod
     def get(user_id):
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        cursor.execute('SELECT id, username, role FROM users WHERE id = ?', (user_id,))
-        row = cursor.fetchone()
-        conn.close()
+        row = db_queries.one('users.by_id', (user_id,))
         if row:
-            return User(row[0], row[1], row[2])
+            return User(row.id, row.username, row.role)
         return None
 
 
 @login_manager.user_loader
 def load_user(user_id):
+    # user ids are per-branch: a session from one branch must not load a user on another
+    if TENANTS and session.get('tenant') != current_tenant():
+        return None
     return User.get(user_id)
 
 
@@ -54,16 +132,944 @@ def role_required(role):
     return decorator
 
 
-def get_db_connection():
-    conn = sqlite3.connect(DATABASE)
+# ---------- Tenants (one SQLite file per branch) ----------
+_tenant_state = threading.local()
+
+
+def tenant_names():
+    return TENANTS or [DEFAULT_TENANT]
+
+
+def tenant_database(tenant):
+    if not TENANTS:
+        return DATABASE
+    return TENANT_DB_TEMPLATE.format(tenant=tenant)
+
+
+def tenant_file(path, tenant=None):
+    """Per-branch variant of an auxiliary file (snapshot, archive): hospital_archive.db -> hospital_archive_north.db."""
+    if not TENANTS:
+        return path
+    root, ext = os.path.splitext(path)
+    return f'{root}_{tenant or current_tenant()}{ext}'
+
+
+def current_tenant():
+    return getattr(_tenant_state, 'tenant', None) or DEFAULT_TENANT
+
+
+def current_database():
+    return tenant_database(current_tenant())
+
+
+@contextmanager
+def use_tenant(tenant):
+    """Run a block (e.g. in a background thread) against one branch's database."""
+    previous = getattr(_tenant_state, 'tenant', None)
+    _tenant_state.tenant = tenant
+    try:
+        yield
+    finally:
+        _tenant_state.tenant = previous
+
+
+def _tenant_from_request():
+    if not TENANTS:
+        return DEFAULT_TENANT
+    # north.hospital.example -> north
+    subdomain = request.host.split(':')[0].split('.')[0]
+    if subdomain in TENANTS:
+        return subdomain
+    candidates = (session.get('tenant'), request.values.get('tenant'))
+    if request.endpoint == 'login':
+        # signing in to another branch: the form wins over the branch left in the session
+        candidates = candidates[::-1]
+    for candidate in candidates:
+        if candidate in TENANTS:
+            return candidate
+    return DEFAULT_TENANT
+
+
+@app.before_request
+def _select_tenant():
+    _tenant_state.tenant = _tenant_from_request()
+
+
+@app.teardown_request
+def _clear_tenant(exc):
+    _tenant_state.tenant = None
+
+
+def _open_connection(path):
+    # 'file:' URIs are the read-only reporting snapshot (see ReportingSnapshot.uri)
+    conn = sqlite3.connect(path, cached_statements=SQLITE_CACHED_STATEMENTS, check_same_thread=False,
+                           uri=path.startswith('file:'))
     conn.row_factory = sqlite3.Row
     return conn
 
 
+def _connect(path, kind='read'):
+    """Open a handle for the pool.
+
+    'read': plain connection. 'archive': attach_archive() already applied (read-only
+    snapshot handles cannot create the archive, so they attach it only if it exists).
+    'writer': autocommit + WAL, owned by the write queue while checked out.
+    """
+    conn = _open_connection(path)
+    if kind == 'archive':
+        attach_archive(conn, create=not path.startswith('file:'))
+    elif kind == 'writer':
+        conn.isolation_level = None  # transactions are managed explicitly by WriteQueue
+        try:
+            conn.execute('PRAGMA journal_mode=WAL')
+        except sqlite3.Error:
+            pass
+    return conn
+
+
+class ConnectionPool:
+    """Every SQLite handle the app keeps, per (database file, kind), with a hard LRU cap.
+
+    A connection is checked out for one unit of work (a statement, a report, a write
+    batch) and handed back, so a few handles per branch serve every request thread.
+    'archive' handles keep the archive attached and the all_* views created, so
+    statements on them reuse the prepared-statement cache like any other. At most
+    ``max_open`` handles exist across all branches and kinds: when the cap is reached
+    the least recently used idle handle is closed, and if every handle is busy the
+    caller waits up to ``wait_seconds`` for one to come back.
+    """
+
+    def __init__(self, max_open=32, wait_seconds=30):
+        self.max_open = max(1, max_open)
+        self.wait_seconds = wait_seconds
+        self._idle = OrderedDict()  # (path, kind) -> [connection, ...], least recently used first
+        self._open = 0
+        self._generation = {}  # path -> bumped by reset(); older handles are closed when returned
+        self._born = {}  # connection -> generation of its path when it was opened
+        self._lock = threading.Condition()
+        self._pid = os.getpid()
+        self.opened = 0
+        self.evicted = 0
+        self.waits = 0
+
+    @contextmanager
+    def connection(self, path=None, kind='read'):
+        key = (path or current_database(), kind)
+        conn = self._checkout(key)
+        try:
+            yield conn
+        except Exception:
+            # don't hand back a handle in an unknown state
+            self._discard(conn)
+            raise
+        else:
+            self._checkin(key, conn)
+
+    def _checkout(self, key):
+        deadline = time.monotonic() + self.wait_seconds
+        with self._lock:
+            if self._pid != os.getpid():
+                # forked worker: the parent's handles are not safe to share
+                self._idle = OrderedDict()
+                self._open = 0
+                self._born = {}
+                self._pid = os.getpid()
+            while True:
+                idle = self._idle.get(key)
+                if idle:
+                    self._idle.move_to_end(key)
+                    return idle.pop()
+                while self._open >= self.max_open and self._evict_one():
+                    pass
+                if self._open < self.max_open:
+                    break
+                # every handle is checked out; wait for one to be returned
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise sqlite3.OperationalError(
+                        f'no database connection free after {self.wait_seconds}s (MAX_OPEN_CONNECTIONS={self.max_open})')
+                self.waits += 1
+                self._lock.wait(remaining)
+            self._open += 1
+            self.opened += 1
+            generation = self._generation.get(key[0], 0)
+        try:
+            conn = _connect(*key)
+        except Exception:
+            with self._lock:
+                self._open -= 1
+                self._lock.notify()
+            raise
+        with self._lock:
+            self._born[conn] = generation
+        return conn
+
+    def _checkin(self, key, conn):
+        if conn.in_transaction:
+            conn.rollback()
+        with self._lock:
+            if self._born.get(conn) != self._generation.get(key[0], 0):
+                self._close(conn)  # its file was replaced (reset) while it was checked out
+            else:
+                self._idle.setdefault(key, []).append(conn)
+                self._idle.move_to_end(key)
+            while self._open > self.max_open and self._evict_one():
+                pass
+            self._lock.notify()
+
+    def _discard(self, conn):
+        with self._lock:
+            self._close(conn)
+            self._lock.notify()
+
+    def _close(self, conn):
+        # caller holds self._lock
+        conn.close()
+        self._born.pop(conn, None)
+        self._open -= 1
+
+    def _evict_one(self):
+        # caller holds self._lock
+        for key, conns in self._idle.items():
+            if conns:
+                self._close(conns.pop(0))
+                self.evicted += 1
+                if not conns:
+                    del self._idle[key]
+                return True
+        return False
+
+    def reset(self, path):
+        """Close idle handles to ``path`` and retire busy ones, e.g. after the file was swapped."""
+        with self._lock:
+            self._generation[path] = self._generation.get(path, 0) + 1
+            for key in [key for key in self._idle if key[0] == path]:
+                for conn in self._idle.pop(key):
+                    self._close(conn)
+            self._lock.notify_all()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'open': self._open,
+                'busy': self._open - sum(len(conns) for conns in self._idle.values()),
+                'max_open': self.max_open,
+                'opened': self.opened,
+                'evicted': self.evicted,
+                'waits': self.waits,
+                'idle': {f'{path} ({kind})': len(conns) for (path, kind), conns in self._idle.items()},
+            }
+
+
+connection_pool = ConnectionPool(MAX_OPEN_CONNECTIONS, CONNECTION_WAIT_SECONDS)
+
+
+# ---------- Write queue (group commit) ----------
+def _percentile(values, pct):
+    if not values:
+        return 0
+    ordered = sorted(values)
+    idx = min(len(ordered) - 1, int(round(pct / 100.0 * (len(ordered) - 1))))
+    return ordered[idx]
+
+
+# lastrowid and rowcount of the last statement in a write (rowcount 0: no row matched), the time spent
+# executing that statement, and the time the write waited before it started (queue, lock, checkout)
+WriteResult = namedtuple('WriteResult', 'lastrowid rowcount exec_ms wait_ms')
+
+
+class _PendingWrite:
+    def __init__(self, statements, database):
+        self.statements = statements
+        self.database = database
+        self.done = threading.Event()
+        self.lastrowid = None
+        self.rowcount = None
+        self.exec_ms = None
+        self.error = None
+        self.enqueued_at = time.perf_counter()
+        self.started_at = None
+
+
+class WriteQueue:
+    """Gathers writes from request threads and commits them in batches.
+
+    A single writer thread per process does all the writing, on 'writer' handles from
+    connection_pool (one per branch file, closed by the pool's LRU cap). It waits up to
+    ``window_ms`` for more writes to arrive (at most ``max_batch``) and commits them
+    in one transaction, so a burst of requests costs one fsync instead of one each.
+    Each write runs in its own savepoint, so a failing statement only fails its caller.
+    Callers block until their batch is committed, which keeps read-your-writes.
+    Writes for different branch databases are committed as separate groups.
+    """
+
+    def __init__(self, max_batch=64, window_ms=5):
+        self.max_batch = max(1, max_batch)
+        self.window = max(0.0, window_ms) / 1000.0
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+        self._batch_sizes = deque(maxlen=1024)
+        self._latencies_ms = deque(maxlen=1024)
+        self.batches = 0
+        self.writes = 0
+        self.errors = 0
+
+    def _ensure_started(self):
+        if self._pid == os.getpid() and self._thread is not None and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._pid == os.getpid() and self._thread is not None and self._thread.is_alive():
+                return
+            if self._pid != os.getpid():
+                # forked worker (e.g. gunicorn): the parent's queue and thread are not ours
+                self._queue = queue.Queue()
+                self._pid = os.getpid()
+            self._thread = threading.Thread(target=self._run, name='write-queue', daemon=True)
+            self._thread.start()
+
+    def submit(self, statements):
+        self._ensure_started()
+        item = _PendingWrite(statements, current_database())
+        self._queue.put(item)
+        item.done.wait()
+        if item.error is not None:
+            raise item.error
+        return WriteResult(item.lastrowid, item.rowcount, item.exec_ms,
+                           (item.started_at - item.enqueued_at) * 1000.0)
+
+    def _collect(self):
+        batch = [self._queue.get()]
+        deadline = time.perf_counter() + self.window
+        while len(batch) < self.max_batch:
+            remaining = deadline - time.perf_counter()
+            try:
+                if remaining > 0:
+                    batch.append(self._queue.get(timeout=remaining))
+                else:
+                    batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            groups = OrderedDict()
+            for item in batch:
+                groups.setdefault(item.database, []).append(item)
+            for database, items in groups.items():
+                # nothing may escape this loop: callers block until their item is marked done
+                try:
+                    with connection_pool.connection(database, 'writer') as conn:
+                        self._commit_batch(conn, items)
+                except Exception as e:
+                    # e.g. a branch database that cannot be opened; fail these writes, keep the thread
+                    for item in items:
+                        if item.error is None:
+                            item.error = e
+                finally:
+                    self._finish(items)
+
+    def _commit_batch(self, conn, batch):
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            for item in batch:
+                item.started_at = time.perf_counter()
+                conn.execute('SAVEPOINT write_item')
+                try:
+                    for sql, params in item.statements:
+                        started = time.perf_counter()
+                        cur = conn.execute(sql, params)
+                        item.exec_ms = (time.perf_counter() - started) * 1000.0
+                        item.lastrowid, item.rowcount = cur.lastrowid, cur.rowcount
+                    conn.execute('RELEASE write_item')
+                except Exception as e:
+                    conn.execute('ROLLBACK TO write_item')
+                    conn.execute('RELEASE write_item')
+                    item.error = e
+            conn.execute('COMMIT')
+        except Exception as e:
+            try:
+                conn.execute('ROLLBACK')
+            except sqlite3.Error:
+                pass
+            for item in batch:
+                if item.error is None:
+                    item.error = e
+
+    def _finish(self, batch):
+        now = time.perf_counter()
+        with self._lock:
+            self.batches += 1
+            self.writes += len(batch)
+            self.errors += sum(1 for item in batch if item.error is not None)
+            self._batch_sizes.append(len(batch))
+            for item in batch:
+                self._latencies_ms.append((now - item.enqueued_at) * 1000.0)
+        for item in batch:
+            item.done.set()
+
+    def metrics(self):
+        with self._lock:
+            sizes = list(self._batch_sizes)
+            latencies = list(self._latencies_ms)
+            return {
+                'enabled': WRITE_QUEUE_ENABLED,
+                'batches': self.batches,
+                'writes': self.writes,
+                'errors': self.errors,
+                'pending': self._queue.qsize(),
+                'max_batch': self.max_batch,
+                'window_ms': self.window * 1000.0,
+                'batch_size': {
+                    'avg': (sum(sizes) / len(sizes)) if sizes else 0,
+                    'p50': _percentile(sizes, 50),
+                    'max': max(sizes) if sizes else 0,
+                },
+                'latency_ms': {
+                    'p50': _percentile(latencies, 50),
+                    'p99': _percentile(latencies, 99),
+                    'max': max(latencies) if latencies else 0,
+                },
+            }
+
+
+write_queue = WriteQueue(WRITE_BATCH_MAX, WRITE_BATCH_WINDOW_MS)
+
+
+def execute_writes(statements):
+    """Run a list of (sql, params) atomically; returns the last statement's WriteResult."""
+    statements = [(sql, tuple(params)) for sql, params in statements]
+    if has_request_context():
+        # lets reporting views skip a snapshot that predates this user's own writes
+        session['last_write_at'] = time.time()
+    if WRITE_QUEUE_ENABLED:
+        return write_queue.submit(statements)
+    checkout = time.perf_counter()
+    with connection_pool.connection() as conn:
+        wait_ms = (time.perf_counter() - checkout) * 1000.0
+        for sql, params in statements:
+            started = time.perf_counter()
+            cur = conn.execute(sql, params)
+        exec_ms = (time.perf_counter() - started) * 1000.0
+        conn.commit()
+        return WriteResult(cur.lastrowid, cur.rowcount, exec_ms, wait_ms)
+
+
+def execute_write(sql, params=()):
+    return execute_writes([(sql, params)])
+
+
+def history_statement(table, row_id, op):
+    """(sql, params) that copies the current row into history; run it before the change."""
+    pairs = ', '.join(f"'{col}', {col}" for col in HISTORY_COLUMNS[table])
+    # same filter as the change itself, so a no-op on a deleted row leaves no history entry
+    live = ' AND deleted_at IS NULL' if table in SOFT_DELETE_TABLES else ''
+    changed_by = None
+    if has_request_context() and current_user.is_authenticated:
+        changed_by = current_user.username
+    return (f"INSERT INTO history (table_name, row_id, op, data, changed_by, changed_at) "
+            f"SELECT ?, id, ?, json_object({pairs}), ?, datetime('now') FROM {table} WHERE id = ?{live}",
+            (table, op, changed_by, row_id))
+
+
+def soft_delete(table, row_id):
+    """Returns False if there was no live row to delete (already deleted, archived or never existed)."""
+    return db_queries.write(f'{table}.soft_delete', (row_id,), history=(table, row_id, 'DELETE')).rowcount > 0
+
+
+def attach_archive(conn, create=False):
+    """Attach the archive DB and create all_appointments / all_invoices temp views.
+
+    The views union the hot tables with their archived rows, so reports and
+    exports keep seeing the full history after the archival job has run. A row
+    present in both files is read from main only: that is the case on a reporting
+    snapshot taken before the row was archived, and after an archival batch that
+    committed to the archive but not to main (the two files do not commit
+    atomically when main is in WAL mode).
+
+    ``create=True`` creates the archive file and tables first, so views on a
+    long-lived (pooled) handle include the archive even before the first archival run.
+    """
+    archived_tables = set()
+    archive_path = tenant_file(ARCHIVE_DATABASE)
+    if create or os.path.exists(archive_path):
+        conn.execute('ATTACH DATABASE ? AS archive', (os.path.abspath(archive_path),))
+        if create:
+            create_archive_tables(conn)
+        archived_tables = {r[0] for r in conn.execute("SELECT name FROM archive.sqlite_master WHERE type = 'table'")}
+    for table, columns in ARCHIVE_COLUMNS.items():
+        cols = ', '.join(columns)
+        sql = f'CREATE TEMP VIEW IF NOT EXISTS all_{table} AS SELECT {cols} FROM main.{table}'
+        if table in archived_tables:
+            sql += (f' UNION ALL SELECT {cols} FROM archive.{table} AS a'
+                    f' WHERE NOT EXISTS (SELECT 1 FROM main.{table} AS m WHERE m.id = a.id)')
+        conn.execute(sql)
+    return conn
+
+
+def create_archive_tables(conn):
+    """Create the archive tables (same columns as the hot tables) on a connection with the archive attached."""
+    for table, columns in ARCHIVE_COLUMNS.items():
+        cols = ', '.join(columns)
+        conn.execute(f'CREATE TABLE IF NOT EXISTS archive.{table} AS SELECT {cols} FROM main.{table} WHERE 0')
+        conn.execute(f'CREATE UNIQUE INDEX IF NOT EXISTS archive.idx_{table}_id ON {table} (id)')
+
+
+# ---------- Reporting snapshot (read replica) ----------
+class ReportingSnapshot:
+    """Read-only copy of the database used by reporting queries.
+
+    The copy is built with the sqlite3 online backup API in a single step, then
+    swapped into place atomically. A step-wise copy restarts whenever another
+    connection writes, so under steady front-desk writes it never finished. One
+    step holds a read lock for the length of the copy: in WAL mode (WRITE_QUEUE=1)
+    writers carry on meanwhile, in rollback-journal mode their commits wait for it.
+    If the source stays locked for ``timeout`` seconds the refresh is abandoned.
+
+    Readers open the copy with ``mode=ro&immutable=1`` so SQLite takes no locks on it
+    at all. A refresh is started in the background once the snapshot is older than
+    ``refresh_seconds``; until then readers keep using the current copy. The
+    ``<snapshot>.tmp`` file doubles as a lock, so only one process (gunicorn worker)
+    rebuilds a given snapshot at a time.
+    """
+
+    def __init__(self, path, source, refresh_seconds=60, timeout=30):
+        self.path = os.path.abspath(path)
+        self.source = source
+        self.refresh_seconds = refresh_seconds
+        self.timeout = timeout
+        self._refresh_lock = threading.Lock()
+        self._pooled_built = None
+        self.last_refresh_ms = None
+        self.refreshes = 0
+        self.failures = 0
+
+    def built_at(self):
+        try:
+            return os.path.getmtime(self.path)
+        except OSError:
+            return None
+
+    def age(self):
+        built = self.built_at()
+        return None if built is None else max(0.0, time.time() - built)
+
+    def refresh(self, only_if_stale=False):
+        """Rebuild the snapshot now; returns False if another thread or process is already at it.
+
+        ``only_if_stale`` skips the copy when another process refreshed it in the meantime.
+        """
+        if not self._refresh_lock.acquire(blocking=False):
+            return False
+        try:
+            tmp_path = self.path + '.tmp'
+            if not self._claim_tmp(tmp_path):
+                return False
+            try:
+                age = self.age()
+                if only_if_stale and age is not None and age < self.refresh_seconds:
+                    return False
+                started = time.perf_counter()
+                self._copy(tmp_path)
+                # Windows refuses to replace a file a reader still has open; retry next time
+                os.replace(tmp_path, self.path)
+            except Exception:
+                self.failures += 1
+                raise
+            finally:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+            self.last_refresh_ms = (time.perf_counter() - started) * 1000.0
+            self.refreshes += 1
+            return True
+        finally:
+            self._refresh_lock.release()
+
+    def _claim_tmp(self, tmp_path):
+        """Create the temp file exclusively; it is the cross-process refresh lock."""
+        for _ in range(2):
+            try:
+                os.close(os.open(tmp_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+                return True
+            except FileExistsError:
+                try:
+                    # left behind by a process that died mid-copy
+                    if time.time() - os.path.getmtime(tmp_path) > 2 * self.timeout:
+                        os.remove(tmp_path)
+                        continue
+                except OSError:
+                    continue
+                return False
+        return False
+
+    def _copy(self, tmp_path):
+        deadline = time.monotonic() + self.timeout
+
+        def progress(status, remaining, total):
+            # only called again while the single step is retried on a busy source
+            if time.monotonic() > deadline:
+                raise sqlite3.OperationalError(f'source stayed locked for {self.timeout}s')
+
+        dst = sqlite3.connect(tmp_path)
+        try:
+            with connection_pool.connection(self.source) as src:
+                src.backup(dst, pages=-1, progress=progress, sleep=0.01)
+            # immutable readers cannot use a WAL, so store the copy in rollback-journal mode
+            dst.execute('PRAGMA journal_mode=DELETE')
+        finally:
+            dst.close()
+
+    def refresh_if_stale(self):
+        age = self.age()
+        if age is not None and age < self.refresh_seconds:
+            return
+        if self._refresh_lock.locked():
+            return
+        threading.Thread(target=self._refresh_quietly, name='snapshot-refresh', daemon=True).start()
+
+    def _refresh_quietly(self):
+        try:
+            self.refresh(only_if_stale=True)
+        except Exception:
+            app.logger.exception('Reporting snapshot refresh of %s failed', self.path)
+
+    def uri(self):
+        """URI to open the snapshot read-only through connection_pool, or None if there is none yet."""
+        self.refresh_if_stale()
+        built = self.built_at()
+        if built is None:
+            return None
+        uri = f'file:{self.path}?mode=ro&immutable=1'
+        if built != self._pooled_built:
+            # the file was swapped (here or by another process): pooled handles still read the old copy
+            self._pooled_built = built
+            connection_pool.reset(uri)
+        return uri
+
+
+reporting_snapshots = {}
+_reporting_snapshots_lock = threading.Lock()
+_reporting_state = threading.local()
+
+
+def get_reporting_snapshot():
+    """The current branch's snapshot, created on first use."""
+    tenant = current_tenant()
+    with _reporting_snapshots_lock:
+        snapshot = reporting_snapshots.get(tenant)
+        if snapshot is None:
+            snapshot = reporting_snapshots[tenant] = ReportingSnapshot(
+                tenant_file(SNAPSHOT_PATH, tenant), tenant_database(tenant),
+                SNAPSHOT_REFRESH_SECONDS, SNAPSHOT_REFRESH_TIMEOUT)
+        return snapshot
+
+
+def reporting_read(f):
+    """Route the reads made by ``f`` through read_connection() to the snapshot."""
+    @wraps(f)
+    def wrapper(*args, **kwargs):
+        previous = getattr(_reporting_state, 'active', False)
+        _reporting_state.active = True
+        try:
+            return f(*args, **kwargs)
+        finally:
+            _reporting_state.active = previous
+    return wrapper
+
+
+@contextmanager
+def read_connection(archive=False):
+    """Connection for read-only queries: the snapshot inside @reporting_read, else the primary.
+
+    ``archive=True`` gives a handle with the archive attached and the all_* views in place.
+    """
+    path = None
+    if REPORTING_SNAPSHOT and getattr(_reporting_state, 'active', False):
+        reporting_snapshot = get_reporting_snapshot()
+        built = reporting_snapshot.built_at()
+        fresh_enough = True
+        if has_request_context() and built is not None:
+            fresh_enough = session.get('last_write_at', 0) < built
+        path = reporting_snapshot.uri() if fresh_enough else None
+        if path is not None and has_request_context():
+            g.snapshot_age = reporting_snapshot.age()
+    with connection_pool.connection(path, 'archive' if archive else 'read') as conn:
+        yield conn
+
+
+@app.context_processor
+def inject_snapshot_age():
+    # templates can show "data as of N seconds ago" when a view was served from the snapshot
+    return {'snapshot_age': g.get('snapshot_age')}
+
+
+@app.after_request
+def add_snapshot_age_header(response):
+    age = g.get('snapshot_age')
+    if age is not None:
+        response.headers['X-Snapshot-Age'] = f'{age:.1f}'
+    return response
+
+
+# ---------- Query registry ----------
+PatientRow = namedtuple('PatientRow', 'id name age gender disease')
+DoctorRow = namedtuple('DoctorRow', 'id name specialty phone email fee')
+AppointmentRow = namedtuple('AppointmentRow', 'id patient doctor date time status')
+InvoiceRow = namedtuple('InvoiceRow', 'id patient amount status created_at due_date description')
+UserRow = namedtuple('UserRow', 'id username role')
+LoginRow = namedtuple('LoginRow', 'id password role')
+HistoryRow = namedtuple('HistoryRow', 'op data changed_by changed_at')
+ChangeRow = namedtuple('ChangeRow', 'id table_name op row_id')
+JobRow = namedtuple('JobRow', 'id kind status result_path error created_at started_at finished_at')
+ClaimedJobRow = namedtuple('ClaimedJobRow', 'id kind params claim_token')
+
+
+class Statement:
+    def __init__(self, name, sql, row_type=None, archive=False):
+        self.name = name
+        self.sql = sql.strip()
+        self.row_type = row_type
+        self.archive = archive
+        self.calls = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+        self.wait_ms = 0.0
+
+
+class QueryRegistry:
+    """Named SQL statements with typed results and per-statement timing.
+
+    Reads default to a pooled connection to the current branch's database that
+    stays open, so SQLite's prepared-statement cache (``SQLITE_CACHED_STATEMENTS``)
+    is reused across requests instead of being thrown away with each connection.
+    Pass ``conn`` to run on another connection (e.g. the reporting snapshot).
+    Statements marked ``archive=True`` read the all_* views and run on a pooled
+    'archive' handle, which has attach_archive() applied once when it is opened.
+    Timings cover execute and fetch only, not the connection checkout. For writes
+    they cover the named statement alone, measured by whoever runs it (the write
+    queue's thread or execute_writes); the wait before it started (queue, commit
+    of earlier batches, connection checkout) is reported separately as ``avg_wait_ms``.
+    """
+
+    def __init__(self):
+        self.statements = {}
+        self._lock = threading.Lock()
+
+    def register(self, name, sql, row_type=None, archive=False):
+        self.statements[name] = Statement(name, sql, row_type, archive)
+
+    def sql(self, name):
+        return self.statements[name].sql
+
+    def _run(self, name, params, conn, fetch):
+        stmt = self.statements[name]
+        if conn is not None:
+            return stmt, self._execute(stmt, conn, params, fetch)
+        with connection_pool.connection(kind='archive' if stmt.archive else 'read') as pooled:
+            return stmt, self._execute(stmt, pooled, params, fetch)
+
+    def _execute(self, stmt, conn, params, fetch):
+        started = time.perf_counter()
+        result = fetch(conn.execute(stmt.sql, params))
+        self._record(stmt, (time.perf_counter() - started) * 1000.0)
+        return result
+
+    def all(self, name, params=(), conn=None):
+        stmt, rows = self._run(name, params, conn, lambda cur: cur.fetchall())
+        if stmt.row_type is not None:
+            return [stmt.row_type._make(r) for r in rows]
+        return rows
+
+    def one(self, name, params=(), conn=None):
+        stmt, row = self._run(name, params, conn, lambda cur: cur.fetchone())
+        if row is not None and stmt.row_type is not None:
+            return stmt.row_type._make(row)
+        return row
+
+    def scalar(self, name, params=(), conn=None):
+        _, row = self._run(name, params, conn, lambda cur: cur.fetchone())
+        return row[0] if row is not None else None
+
+    def write(self, name, params=(), history=None):
+        """Run a named write via execute_writes(); ``history=(table, id, op)`` records the old row first."""
+        stmt = self.statements[name]
+        statements = [(stmt.sql, params)]
+        if history is not None:
+            statements.insert(0, history_statement(*history))
+        result = execute_writes(statements)
+        self._record(stmt, result.exec_ms, result.wait_ms)
+        return result
+
+    def _record(self, stmt, elapsed_ms, wait_ms=0.0):
+        with self._lock:
+            stmt.calls += 1
+            stmt.total_ms += elapsed_ms
+            stmt.max_ms = max(stmt.max_ms, elapsed_ms)
+            stmt.wait_ms += wait_ms
+
+    def explain(self, name):
+        """EXPLAIN QUERY PLAN details for a statement, to check it uses an index."""
+        stmt = self.statements[name]
+        with connection_pool.connection(kind='archive' if stmt.archive else 'read') as conn:
+            rows = conn.execute('EXPLAIN QUERY PLAN ' + stmt.sql, (None,) * stmt.sql.count('?')).fetchall()
+        return [r[-1] for r in rows]
+
+    def stats(self):
+        with self._lock:
+            rows = [{
+                'name': stmt.name,
+                'calls': stmt.calls,
+                'total_ms': stmt.total_ms,
+                'avg_ms': stmt.total_ms / stmt.calls if stmt.calls else 0,
+                'max_ms': stmt.max_ms,
+                'avg_wait_ms': stmt.wait_ms / stmt.calls if stmt.calls else 0,
+            } for stmt in self.statements.values()]
+        return sorted(rows, key=lambda r: r['total_ms'], reverse=True)
+
+
+db_queries = QueryRegistry()
+Q = db_queries.register
+
+# users
+Q('users.by_id', 'SELECT id, username, role FROM users WHERE id = ?', UserRow)
+Q('users.by_username', 'SELECT id, password, role FROM users WHERE username = ?', LoginRow)
+
+# patients
+Q('patients.count', 'SELECT COUNT(*) FROM patients WHERE deleted_at IS NULL')
+Q('patients.count_search', 'SELECT COUNT(*) FROM patients WHERE deleted_at IS NULL AND name LIKE ?')
+Q('patients.page', 'SELECT id, name, age, gender, disease FROM patients WHERE deleted_at IS NULL LIMIT ? OFFSET ?',
+  PatientRow)
+Q('patients.search_page', 'SELECT id, name, age, gender, disease FROM patients '
+  'WHERE deleted_at IS NULL AND name LIKE ? LIMIT ? OFFSET ?', PatientRow)
+Q('patients.active', 'SELECT id, name, age, gender, disease FROM patients WHERE deleted_at IS NULL', PatientRow)
+Q('patients.by_id', 'SELECT id, name, age, gender, disease FROM patients WHERE id = ? AND deleted_at IS NULL',
+  PatientRow)
+Q('patients.insert', 'INSERT INTO patients (name, age, gender, disease) VALUES (?, ?, ?, ?)')
+Q('patients.update', 'UPDATE patients SET name=?, age=?, gender=?, disease=? WHERE id = ? AND deleted_at IS NULL')
+
+# doctors
+Q('doctors.count', 'SELECT COUNT(*) FROM doctors WHERE deleted_at IS NULL')
+Q('doctors.active', 'SELECT id, name, specialty, phone, email, fee FROM doctors WHERE deleted_at IS NULL', DoctorRow)
+Q('doctors.by_id', 'SELECT id, name, specialty, phone, email, fee FROM doctors WHERE id = ? AND deleted_at IS NULL',
+  DoctorRow)
+Q('doctors.insert', 'INSERT INTO doctors (name, specialty, phone, email, fee) VALUES (?, ?, ?, ?, ?)')
+Q('doctors.update', 'UPDATE doctors SET name=?, specialty=?, phone=?, email=?, fee=? WHERE id=? AND deleted_at IS NULL')
+
+# appointments
+APPOINTMENT_SELECT = '''
+    SELECT a.id, p.name, d.name, a.date, a.time, a.status
+    FROM appointments a
+    LEFT JOIN patients p ON a.patient_id = p.id
+    LEFT JOIN doctors d ON a.doctor_id = d.id
+'''
+Q('appointments.list', APPOINTMENT_SELECT + 'ORDER BY a.date DESC, a.time DESC', AppointmentRow)
+Q('appointments.by_ids', APPOINTMENT_SELECT + 'WHERE a.id IN (SELECT value FROM json_each(?))', AppointmentRow)
+# hot rows plus the archive job's running totals; the all_* views would check every archived row
+Q('appointments.count_all', "SELECT (SELECT COUNT(*) FROM appointments) + "
+  "COALESCE((SELECT row_count FROM archive_totals WHERE table_name = 'appointments'), 0)")
+Q('appointments.insert', 'INSERT INTO appointments (patient_id, doctor_id, date, time) VALUES (?, ?, ?, ?)')
+Q('appointments.cancel', "UPDATE appointments SET status='Cancelled' WHERE id = ?")
+
+# invoices
+INVOICE_COLUMNS = 'i.id, p.name, i.amount, i.status, i.created_at, i.due_date, i.description'
+Q('invoices.list', f'''
+    SELECT {INVOICE_COLUMNS}
+    FROM invoices i
+    LEFT JOIN patients p ON i.patient_id = p.id
+    WHERE i.deleted_at IS NULL
+    ORDER BY i.created_at DESC
+''', InvoiceRow)
+Q('invoices.by_ids', f'SELECT {INVOICE_COLUMNS} FROM invoices i LEFT JOIN patients p ON i.patient_id = p.id '
+  'WHERE i.id IN (SELECT value FROM json_each(?))', InvoiceRow)
+# all_invoices so exports and links to archived invoices keep working
+Q('invoices.by_id', f'SELECT {INVOICE_COLUMNS} FROM all_invoices i LEFT JOIN patients p ON i.patient_id = p.id '
+  'WHERE i.id = ? AND i.deleted_at IS NULL', InvoiceRow, archive=True)
+Q('invoices.export', f'SELECT {INVOICE_COLUMNS} FROM all_invoices i LEFT JOIN patients p ON i.patient_id = p.id '
+  'WHERE i.deleted_at IS NULL', InvoiceRow, archive=True)
+Q('invoices.paid_total', "SELECT TOTAL(amount) + "
+  "COALESCE((SELECT amount FROM archive_totals WHERE table_name = 'invoices'), 0) "
+  "FROM invoices WHERE status='Paid' AND deleted_at IS NULL")
+# only paid invoices are archived, so outstanding amounts live in the hot table
+Q('invoices.unpaid_total', "SELECT SUM(amount) FROM invoices WHERE status!='Paid' AND deleted_at IS NULL")
+Q('invoices.insert', 'INSERT INTO invoices (patient_id, amount, status, description, created_at, due_date) '
+  'VALUES (?, ?, ?, ?, datetime("now"), ?)')
+Q('invoices.pay', "UPDATE invoices SET status='Paid' WHERE id = ? AND deleted_at IS NULL")
+Q('invoices.mark_overdue', "UPDATE invoices SET status='Overdue' "
+  "WHERE status='Unpaid' AND due_date IS NOT NULL AND due_date != '' AND due_date < date('now')")
+
+for _table in SOFT_DELETE_TABLES:
+    Q(f'{_table}.soft_delete', f"UPDATE {_table} SET deleted_at = datetime('now') WHERE id = ? AND deleted_at IS NULL")
+
+# history / changelog
+Q('history.for_row', 'SELECT op, data, changed_by, changed_at FROM history '
+  'WHERE table_name = ? AND row_id = ? ORDER BY id DESC', HistoryRow)
+Q('changelog.max_id', 'SELECT COALESCE(MAX(id), 0) FROM changelog')
+Q('changelog.since', 'SELECT id, table_name, op, row_id FROM changelog WHERE id > ? ORDER BY id LIMIT ?',
+  ChangeRow)
+Q('changelog.prune', "DELETE FROM changelog WHERE changed_at < datetime('now', ?)")
+
+# jobs
+Q('jobs.by_id', 'SELECT id, kind, status, result_path, error, created_at, started_at, finished_at '
+  'FROM jobs WHERE id = ?', JobRow)
+Q('jobs.by_claim', 'SELECT id, kind, params, claim_token FROM jobs WHERE claim_token = ?', ClaimedJobRow)
+Q('jobs.dedupe_exists', 'SELECT 1 FROM jobs WHERE dedupe_key = ?')
+Q('jobs.result_path', "SELECT result_path FROM jobs WHERE id = ? AND status = 'done'")
+Q('jobs.insert', 'INSERT INTO jobs (kind, params, status, dedupe_key, created_by, run_after, created_at) '
+  'VALUES (?, ?, ?, ?, ?, ?, datetime("now"))')
+# with a dedupe_key the insert is skipped if that key already exists (e.g. today's nightly job)
+Q('jobs.insert_dedupe', 'INSERT OR IGNORE INTO jobs (kind, params, status, dedupe_key, created_by, run_after, created_at) '
+  'VALUES (?, ?, ?, ?, ?, ?, datetime("now"))')
+# idle workers only read; the claim write happens once a due job exists
+Q('jobs.next_due', "SELECT id FROM jobs WHERE status='queued' "
+  "AND (run_after IS NULL OR run_after <= datetime('now')) ORDER BY id LIMIT 1")
+# status='queued' makes the claim a no-op if another worker got there first
+Q('jobs.claim', "UPDATE jobs SET status='running', claim_token=?, started_at=datetime('now'), "
+  "heartbeat_at=datetime('now') WHERE id = ? AND status='queued'")
+Q('jobs.heartbeat', "UPDATE jobs SET heartbeat_at=datetime('now') WHERE id = ? AND claim_token = ?")
+# claim_token: a worker whose job was requeued as stale (and claimed again) must not overwrite the new run
+Q('jobs.done', "UPDATE jobs SET status='done', result_path=?, finished_at=datetime('now') "
+  "WHERE id = ? AND claim_token = ?")
+Q('jobs.failed', "UPDATE jobs SET status='failed', error=?, finished_at=datetime('now') "
+  "WHERE id = ? AND claim_token = ?")
+# requeue jobs whose worker died (process restart, OOM kill) mid-run: live workers keep heartbeat_at fresh
+Q('jobs.has_stale', "SELECT 1 FROM jobs WHERE status='running' "
+  "AND COALESCE(heartbeat_at, started_at) < datetime('now', ?) LIMIT 1")
+Q('jobs.requeue_stale', "UPDATE jobs SET status='queued', claim_token=NULL, started_at=NULL, heartbeat_at=NULL "
+  "WHERE status='running' AND COALESCE(heartbeat_at, started_at) < datetime('now', ?)")
+# export files older than the retention are deleted; their jobs stop offering a download
+Q('jobs.expire_results', "UPDATE jobs SET result_path=NULL "
+  "WHERE result_path IS NOT NULL AND finished_at < datetime('now', ?)")
+
+
+def _ensure_column(cursor, table, column, decl):
+    cursor.execute(f"PRAGMA table_info({table})")
+    existing_cols = [r[1] for r in cursor.fetchall()]
+    if column not in existing_cols:
+        try:
+            cursor.execute(f"ALTER TABLE {table} ADD COLUMN {column} {decl}")
+        except Exception:
+            pass
+
+
 def init_db():
-    created = not os.path.exists(DATABASE)
-    conn = get_db_connection()
-    cursor = conn.cursor()
+    created = not os.path.exists(current_database())
+    with connection_pool.connection() as conn:
+        _create_tables(conn.cursor(), created)
+        conn.commit()
+    if os.path.exists(tenant_file(ARCHIVE_DATABASE)):
+        # archives written before archive_totals existed: count them once (OR IGNORE keeps later runs no-ops)
+        with connection_pool.connection(kind='archive') as conn:
+            for table, amount in ARCHIVE_TOTALS.items():
+                conn.execute(f'INSERT OR IGNORE INTO main.archive_totals (table_name, row_count, amount) '
+                             f'SELECT ?, COUNT(*), TOTAL({amount}) FROM archive.{table} AS a '
+                             f'WHERE NOT EXISTS (SELECT 1 FROM main.{table} AS m WHERE m.id = a.id)', (table,))
+            conn.commit()
+
+
+def _create_tables(cursor, created):
 
     # users table (include role)
     cursor.execute('''
@@ -76,13 +1082,7 @@ def init_db():
     ''')
 
     # ensure 'role' column exists for older DBs
-    cursor.execute("PRAGMA table_info(users)")
-    existing_cols = [r[1] for r in cursor.fetchall()]
-    if 'role' not in existing_cols:
-        try:
-            cursor.execute("ALTER TABLE users ADD COLUMN role TEXT DEFAULT 'staff'")
-        except Exception:
-            pass
+    _ensure_column(cursor, 'users', 'role', "TEXT DEFAULT 'staff'")
 
     cursor.execute('''
         CREATE TABLE IF NOT EXISTS patients (
@@ -130,6 +1130,85 @@ def init_db():
         )
     ''')
 
+    # soft delete: rows keep existing (and keep their names in joins) with deleted_at set
+    for table in SOFT_DELETE_TABLES:
+        _ensure_column(cursor, table, 'deleted_at', 'TEXT')
+
+    # history: previous version of a row (as JSON) for every tracked update/delete
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS history (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            table_name TEXT NOT NULL,
+            row_id INTEGER NOT NULL,
+            op TEXT NOT NULL,
+            data TEXT,
+            changed_by TEXT,
+            changed_at TEXT
+        )
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_history_row ON history (table_name, row_id)')
+    # used by the archival job to find closed rows
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_appointments_status_date ON appointments (status, date)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_invoices_status_created ON invoices (status, created_at)')
+
+    # jobs table: background job queue (no external broker)
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS jobs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            kind TEXT NOT NULL,
+            params TEXT,
+            status TEXT DEFAULT 'queued',
+            result_path TEXT,
+            error TEXT,
+            dedupe_key TEXT UNIQUE,
+            claim_token TEXT,
+            created_by TEXT,
+            run_after TEXT,
+            created_at TEXT,
+            started_at TEXT,
+            heartbeat_at TEXT,
+            finished_at TEXT
+        )
+    ''')
+    # jobs tables created before heartbeats were added
+    _ensure_column(cursor, 'jobs', 'heartbeat_at', 'TEXT')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_jobs_status_run_after ON jobs (status, run_after)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_jobs_claim_token ON jobs (claim_token)')
+
+    # changelog: filled by triggers so every write path (routes, jobs, scripts) feeds the dashboard
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS changelog (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            table_name TEXT NOT NULL,
+            op TEXT NOT NULL,
+            row_id INTEGER,
+            changed_at TEXT
+        )
+    ''')
+    # running totals of archived rows, kept by the archive job in the same transaction as its deletes
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS archive_totals (
+            table_name TEXT PRIMARY KEY,
+            row_count INTEGER NOT NULL DEFAULT 0,
+            amount REAL NOT NULL DEFAULT 0
+        )
+    ''')
+
+    # while a transaction holds a row here the triggers stay quiet (the archive job moving rows out)
+    cursor.execute('CREATE TABLE IF NOT EXISTS changelog_suspended (reason TEXT)')
+    for table in CHANGELOG_TABLES:
+        for op, ref in (('INSERT', 'NEW'), ('UPDATE', 'NEW'), ('DELETE', 'OLD')):
+            # recreated every start so databases with the older, unguarded triggers pick up the WHEN clause
+            cursor.execute(f'DROP TRIGGER IF EXISTS trg_{table}_{op.lower()}_changelog')
+            cursor.execute(f'''
+                CREATE TRIGGER trg_{table}_{op.lower()}_changelog AFTER {op} ON {table}
+                WHEN NOT EXISTS (SELECT 1 FROM changelog_suspended)
+                BEGIN
+                    INSERT INTO changelog (table_name, op, row_id, changed_at)
+                    VALUES ('{table}', '{op}', {ref}.id, datetime('now'));
+                END
+            ''')
+
     # Seed users (with role)
     users = [
         ('admin', 'password', 'admin'),
@@ -165,9 +1244,6 @@ def init_db():
         for d in doctors_seed:
             cursor.execute('INSERT INTO doctors (name, specialty, phone, email, fee) VALUES (?, ?, ?, ?, ?)', d)
 
-    conn.commit()
-    conn.close()
-
 
 @app.route('/', methods=['GET'])
 @login_required
@@ -181,40 +1257,19 @@ def index():
     per_page = 10
     offset = (page - 1) * per_page
 
-    conn = get_db_connection()
-    cursor = conn.cursor()
-
     if q:
-        cursor.execute('SELECT COUNT(*) FROM patients WHERE name LIKE ?', (f'%{q}%',))
-        total = cursor.fetchone()[0]
-        cursor.execute('SELECT * FROM patients WHERE name LIKE ? LIMIT ? OFFSET ?', (f'%{q}%', per_page, offset))
+        total = db_queries.scalar('patients.count_search', (f'%{q}%',))
+        patients = db_queries.all('patients.search_page', (f'%{q}%', per_page, offset))
     else:
-        cursor.execute('SELECT COUNT(*) FROM patients')
-        total = cursor.fetchone()[0]
-        cursor.execute('SELECT * FROM patients LIMIT ? OFFSET ?', (per_page, offset))
-
-    patients = cursor.fetchall()
-
-    # quick dashboard stats
-    cursor.execute(COUNT_DOCTORS_QUERY)
-    total_doctors = cursor.fetchone()[0]
-    cursor.execute('SELECT COUNT(*) FROM appointments')
-    total_appointments = cursor.fetchone()[0]
-    cursor.execute("SELECT SUM(amount) FROM invoices WHERE status='Paid'")
-    total_revenue = cursor.fetchone()[0] or 0
-    cursor.execute("SELECT SUM(amount) FROM invoices WHERE status!='Paid'")
-    total_unpaid = cursor.fetchone()[0] or 0
+        total = db_queries.scalar('patients.count')
+        patients = db_queries.all('patients.page', (per_page, offset))
 
-    conn.close()
+    # quick dashboard stats (same figures as the report, but patients follows the search)
+    totals = report_totals()
+    totals['patients'] = total
 
     total_pages = (total + per_page - 1) // per_page
-    return render_template('index.html', patients=patients, q=q, page=page, total_pages=total_pages, total=total, per_page=per_page, totals={
-        'patients': total,
-        'doctors': total_doctors,
-        'appointments': total_appointments,
-        'revenue': total_revenue,
-        'unpaid': total_unpaid
-    })
+    return render_template('index.html', patients=patients, q=q, page=page, total_pages=total_pages, total=total, per_page=per_page, totals=totals)
 
 
 @app.route('/login', methods=['GET', 'POST'])
@@ -223,17 +1278,14 @@ def login():
         username = request.form.get('username', '').strip()
         password = request.form.get('password', '').strip()
 
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        cursor.execute('SELECT id, password, role FROM users WHERE username = ?', (username,))
-        row = cursor.fetchone()
-        conn.close()
+        row = db_queries.one('users.by_username', (username,))
 
-        if row and check_password_hash(row[1], password):
-            user_obj = User(row[0], username, row[2] or 'staff')
+        if row and check_password_hash(row.password, password):
+            user_obj = User(row.id, username, row.role or 'staff')
             login_user(user_obj)
             session['user'] = username
             session['role'] = user_obj.role
+            session['tenant'] = current_tenant()
             return redirect(url_for('index'))
         else:
             flash('Invalid username or password!', 'danger')
@@ -250,6 +1302,7 @@ def logout():
         pass
     session.pop('user', None)
     session.pop('role', None)
+    session.pop('tenant', None)
     return redirect(url_for('login'))
 
 
@@ -271,12 +1324,7 @@ def add_patient():
         flash('Invalid age', 'danger')
         return redirect(url_for('index'))
 
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute('INSERT INTO patients (name, age, gender, disease) VALUES (?, ?, ?, ?)',
-                   (name, age_val, gender, disease))
-    conn.commit()
-    conn.close()
+    db_queries.write('patients.insert', (name, age_val, gender, disease))
     flash('Patient added', 'success')
     return redirect(url_for('index'))
 
@@ -286,12 +1334,10 @@ def add_patient():
 def delete_patient(id):
     if 'user' not in session:
         return redirect(url_for('login'))
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute('DELETE FROM patients WHERE id = ?', (id,))
-    conn.commit()
-    conn.close()
-    flash('Patient deleted', 'success')
+    if soft_delete('patients', id):
+        flash('Patient deleted', 'success')
+    else:
+        flash('Patient not found', 'danger')
     return redirect(url_for('index'))
 
 
@@ -300,8 +1346,6 @@ def delete_patient(id):
 def edit_patient(id):
     if 'user' not in session:
         return redirect(url_for('login'))
-    conn = get_db_connection()
-    cursor = conn.cursor()
     if request.method == 'POST':
         name = request.form.get('name', '').strip()
         age = request.form.get('age')
@@ -312,16 +1356,15 @@ def edit_patient(id):
         except ValueError:
             flash('Invalid age', 'danger')
             return redirect(url_for('edit_patient', id=id))
-        cursor.execute('UPDATE patients SET name=?, age=?, gender=?, disease=? WHERE id = ?',
-                       (name, age_val, gender, disease, id))
-        conn.commit()
-        conn.close()
-        flash('Patient updated', 'success')
+        result = db_queries.write('patients.update', (name, age_val, gender, disease, id),
+                                  history=('patients', id, 'UPDATE'))
+        if result.rowcount:
+            flash('Patient updated', 'success')
+        else:
+            flash('Patient not found', 'danger')
         return redirect(url_for('index'))
 
-    cursor.execute('SELECT * FROM patients WHERE id = ?', (id,))
-    patient = cursor.fetchone()
-    conn.close()
+    patient = db_queries.one('patients.by_id', (id,))
     if not patient:
         flash('Patient not found', 'danger')
         return redirect(url_for('index'))
@@ -334,8 +1377,6 @@ def edit_patient(id):
 def doctors():
     if 'user' not in session:
         return redirect(url_for('login'))
-    conn = get_db_connection()
-    cursor = conn.cursor()
     if request.method == 'POST':
         name = request.form.get('name', '').strip()
         specialty = request.form.get('specialty', '').strip()
@@ -350,16 +1391,11 @@ def doctors():
         if not name:
             flash('Doctor name is required', 'danger')
             return redirect(url_for('doctors'))
-        cursor.execute('INSERT INTO doctors (name, specialty, phone, email, fee) VALUES (?, ?, ?, ?, ?)',
-                       (name, specialty, phone, email, fee_val))
-        conn.commit()
-        conn.close()
+        db_queries.write('doctors.insert', (name, specialty, phone, email, fee_val))
         flash('Doctor added', 'success')
         return redirect(url_for('doctors'))
 
-    cursor.execute('SELECT * FROM doctors')
-    doctors_list = cursor.fetchall()
-    conn.close()
+    doctors_list = db_queries.all('doctors.active')
     return render_template('doctors.html', doctors=doctors_list)
 
 
@@ -368,8 +1404,6 @@ def doctors():
 def edit_doctor(id):
     if 'user' not in session:
         return redirect(url_for('login'))
-    conn = get_db_connection()
-    cursor = conn.cursor()
     if request.method == 'POST':
         name = request.form.get('name', '').strip()
         specialty = request.form.get('specialty', '').strip()
@@ -381,16 +1415,15 @@ def edit_doctor(id):
         except ValueError:
             flash('Invalid fee', 'danger')
             return redirect(url_for('edit_doctor', id=id))
-        cursor.execute('UPDATE doctors SET name=?, specialty=?, phone=?, email=?, fee=? WHERE id=?',
-                       (name, specialty, phone, email, fee_val, id))
-        conn.commit()
-        conn.close()
-        flash('Doctor updated', 'success')
+        result = db_queries.write('doctors.update', (name, specialty, phone, email, fee_val, id),
+                                  history=('doctors', id, 'UPDATE'))
+        if result.rowcount:
+            flash('Doctor updated', 'success')
+        else:
+            flash('Doctor not found', 'danger')
         return redirect(url_for('doctors'))
 
-    cursor.execute('SELECT * FROM doctors WHERE id = ?', (id,))
-    doctor = cursor.fetchone()
-    conn.close()
+    doctor = db_queries.one('doctors.by_id', (id,))
     if not doctor:
         flash('Doctor not found', 'danger')
         return redirect(url_for('doctors'))
@@ -401,12 +1434,10 @@ def edit_doctor(id):
 @login_required
 @role_required('admin')
 def delete_doctor(id):
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute('DELETE FROM doctors WHERE id = ?', (id,))
-    conn.commit()
-    conn.close()
-    flash('Doctor deleted', 'success')
+    if soft_delete('doctors', id):
+        flash('Doctor deleted', 'success')
+    else:
+        flash('Doctor not found', 'danger')
     return redirect(url_for('doctors'))
 
 
@@ -416,8 +1447,6 @@ def delete_doctor(id):
 def appointments():
     if 'user' not in session:
         return redirect(url_for('login'))
-    conn = get_db_connection()
-    cursor = conn.cursor()
     if request.method == 'POST':
         patient_id = request.form.get('patient_id')
         doctor_id = request.form.get('doctor_id')
@@ -426,47 +1455,32 @@ def appointments():
         if not patient_id or not doctor_id or not date or not time:
             flash('All fields are required', 'danger')
             return redirect(url_for('appointments'))
-        cursor.execute('INSERT INTO appointments (patient_id, doctor_id, date, time) VALUES (?, ?, ?, ?)',
-                       (patient_id, doctor_id, date, time))
-        conn.commit()
-        conn.close()
+        db_queries.write('appointments.insert', (patient_id, doctor_id, date, time))
         flash('Appointment scheduled', 'success')
         return redirect(url_for('appointments'))
 
-    cursor.execute('''
-        SELECT a.id, p.name, d.name, a.date, a.time, a.status
-        FROM appointments a
-        LEFT JOIN patients p ON a.patient_id = p.id
-        LEFT JOIN doctors d ON a.doctor_id = d.id
-        ORDER BY a.date DESC, a.time DESC
-    ''')
-    appointments_list = cursor.fetchall()
-    cursor.execute('SELECT * FROM patients')
-    patients = cursor.fetchall()
-    cursor.execute('SELECT * FROM doctors')
-    doctors = cursor.fetchall()
-    conn.close()
+    appointments_list = db_queries.all('appointments.list')
+    patients = db_queries.all('patients.active')
+    doctors = db_queries.all('doctors.active')
     return render_template('appointments.html', appointments=appointments_list, patients=patients, doctors=doctors)
 
 
 @app.route('/cancel_appointment/<int:id>', methods=['POST'])
 @login_required
 def cancel_appointment(id):
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute("UPDATE appointments SET status='Cancelled' WHERE id = ?", (id,))
-    conn.commit()
-    conn.close()
-    flash('Appointment cancelled', 'success')
+    if db_queries.write('appointments.cancel', (id,), history=('appointments', id, 'UPDATE')).rowcount:
+        flash('Appointment cancelled', 'success')
+    else:
+        # archived appointments are read-only
+        flash('Appointment not found', 'danger')
     return redirect(url_for('appointments'))
 
 
 # ---------- Billing / Reports (new) ----------
 @app.route('/billing', methods=['GET', 'POST'])
 @login_required
+@reporting_read
 def billing():
-    conn = get_db_connection()
-    cursor = conn.cursor()
     if request.method == 'POST':
         patient_id = request.form.get('patient_id')
         amount = request.form.get('amount')
@@ -477,34 +1491,20 @@ def billing():
         except (ValueError, TypeError):
             flash('Invalid amount', 'danger')
             return redirect(url_for('billing'))
-        cursor.execute('INSERT INTO invoices (patient_id, amount, status, description, created_at, due_date) VALUES (?, ?, ?, ?, datetime("now"), ?)',
-                       (patient_id, amount_val, 'Unpaid', description, due_date))
-        conn.commit()
-        conn.close()
+        db_queries.write('invoices.insert', (patient_id, amount_val, 'Unpaid', description, due_date))
         flash('Invoice added', 'success')
         return redirect(url_for('billing'))
 
-    cursor.execute('''
-        SELECT i.id, p.name, i.amount, i.status, i.created_at, i.due_date, i.description
-        FROM invoices i
-        LEFT JOIN patients p ON i.patient_id = p.id
-        ORDER BY i.created_at DESC
-    ''')
-    invoices = cursor.fetchall()
-    cursor.execute('SELECT * FROM patients')
-    patients = cursor.fetchall()
-    conn.close()
+    with read_connection() as conn:
+        invoices = db_queries.all('invoices.list', conn=conn)
+        patients = db_queries.all('patients.active', conn=conn)
     return render_template('billing.html', invoices=invoices, patients=patients)
 
 
 @app.route('/invoice/<int:id>', methods=['GET'])
 @login_required
 def invoice(id):
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute('SELECT i.id, p.name, i.amount, i.status, i.created_at, i.due_date, i.description FROM invoices i LEFT JOIN patients p ON i.patient_id = p.id WHERE i.id = ?', (id,))
-    inv = cursor.fetchone()
-    conn.close()
+    inv = db_queries.one('invoices.by_id', (id,))
     if not inv:
         flash('Invoice not found', 'danger')
         return redirect(url_for('billing'))
@@ -514,87 +1514,634 @@ def invoice(id):
 @app.route('/pay_invoice/<int:id>', methods=['POST'])
 @login_required
 def pay_invoice(id):
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute("UPDATE invoices SET status='Paid' WHERE id = ?", (id,))
-    conn.commit()
-    conn.close()
-    flash('Invoice marked as paid', 'success')
+    if db_queries.write('invoices.pay', (id,), history=('invoices', id, 'UPDATE')).rowcount:
+        flash('Invoice marked as paid', 'success')
+    else:
+        # deleted, or archived (only paid invoices are archived, so nothing is lost)
+        flash('Invoice not found', 'danger')
     return redirect(url_for('billing'))
 
 
 @app.route('/export_invoices', methods=['GET'])
 @login_required
 def export_invoices():
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute('SELECT i.id, p.name, i.amount, i.status, i.created_at, i.due_date, i.description FROM invoices i LEFT JOIN patients p ON i.patient_id = p.id')
-    rows = cursor.fetchall()
-    conn.close()
-
-    si = StringIO()
-    cw = csv.writer(si)
-    cw.writerow(['id', 'patient', 'amount', 'status', 'created_at', 'due_date', 'description'])
-    for r in rows:
-        cw.writerow(r)
-    output = si.getvalue()
-    return Response(output, mimetype='text/csv', headers={"Content-Disposition": "attachment;filename=invoices.csv"})
+    # full-table CSVs run as background jobs; the status page links the file once it is ready
+    return redirect(url_for('job_status', id=start_user_job('export_invoices')), code=303)
 
 
 @app.route('/delete_invoice/<int:id>', methods=['POST'])
 @login_required
 def delete_invoice(id):
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute('DELETE FROM invoices WHERE id = ?', (id,))
-    conn.commit()
-    conn.close()
-    flash('Invoice deleted', 'success')
+    if soft_delete('invoices', id):
+        flash('Invoice deleted', 'success')
+    else:
+        flash('Invoice not found or already archived', 'danger')
     return redirect(url_for('billing'))
 
 
 @app.route('/report', methods=['GET'])
 @login_required
+@reporting_read
 def report():
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute('SELECT COUNT(*) FROM patients')
-    total_patients = cursor.fetchone()[0]
-    cursor.execute(COUNT_DOCTORS_QUERY)
-    total_doctors = cursor.fetchone()[0]
-    cursor.execute('SELECT COUNT(*) FROM appointments')
-    total_appointments = cursor.fetchone()[0]
-    cursor.execute("SELECT SUM(amount) FROM invoices WHERE status='Paid'")
-    total_revenue = cursor.fetchone()[0] or 0
-    cursor.execute("SELECT SUM(amount) FROM invoices WHERE status!='Paid'")
-    total_unpaid = cursor.fetchone()[0] or 0
-    conn.close()
-    return render_template('report.html', totals={
+    return render_template('report.html', totals=report_totals())
+
+
+@app.route('/export_patients', methods=['GET'])
+@login_required
+def export_patients():
+    return redirect(url_for('job_status', id=start_user_job('export_patients')), code=303)
+
+
+# ---------- Report / export helpers (shared by routes and background jobs) ----------
+def report_totals():
+    with read_connection() as conn:
+        total_patients = db_queries.scalar('patients.count', conn=conn)
+        total_doctors = db_queries.scalar('doctors.count', conn=conn)
+        total_appointments = db_queries.scalar('appointments.count_all', conn=conn)
+        total_revenue = db_queries.scalar('invoices.paid_total', conn=conn) or 0
+        total_unpaid = db_queries.scalar('invoices.unpaid_total', conn=conn) or 0
+    return {
         'patients': total_patients,
         'doctors': total_doctors,
         'appointments': total_appointments,
         'revenue': total_revenue,
         'unpaid': total_unpaid
-    })
+    }
 
 
-@app.route('/export_patients', methods=['GET'])
-@login_required
-def export_patients():
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute('SELECT id, name, age, gender, disease FROM patients')
-    rows = cursor.fetchall()
-    conn.close()
-    si = StringIO()
-    cw = csv.writer(si)
+def write_invoices_csv(fileobj):
+    with read_connection(archive=True) as conn:
+        rows = db_queries.all('invoices.export', conn=conn)
+    cw = csv.writer(fileobj)
+    cw.writerow(['id', 'patient', 'amount', 'status', 'created_at', 'due_date', 'description'])
+    cw.writerows(rows)
+
+
+def write_patients_csv(fileobj):
+    with read_connection() as conn:
+        rows = db_queries.all('patients.active', conn=conn)
+    cw = csv.writer(fileobj)
     cw.writerow(['id', 'name', 'age', 'gender', 'disease'])
-    for r in rows:
-        cw.writerow(r)
-    output = si.getvalue()
-    return Response(output, mimetype='text/csv', headers={"Content-Disposition": "attachment;filename=patients.csv"})
+    cw.writerows(rows)
+
+
+# ---------- Background jobs ----------
+# Handlers take the job id and its params dict and return a result file path (or None).
+JOB_HANDLERS = {}
+# kinds users may enqueue from the web UI; scheduled maintenance jobs are not listed here
+USER_JOB_KINDS = ('export_invoices', 'export_patients', 'report')
+# kind -> dedupe key template; one job per key is ever inserted (keyed by UTC date => nightly)
+SCHEDULED_JOBS = {
+    'mark_overdue_invoices': 'mark_overdue_invoices:{today}',
+    'prune_changelog': 'prune_changelog:{today}',
+    'archive_closed_records': 'archive_closed_records:{today}',
+    'prune_exports': 'prune_exports:{today}',
+}
+
+_job_wakeup = threading.Event()
+_job_runner_lock = threading.Lock()
+_job_runner_pid = None
+_last_schedule_check = {}  # tenant -> time.time() of the last scheduling pass
+
+
+def job_handler(kind):
+    def decorator(f):
+        JOB_HANDLERS[kind] = f
+        return f
+    return decorator
+
+
+def _job_output_folder():
+    # job ids are per-branch, so each branch gets its own export folder
+    return os.path.join(EXPORT_DIR, current_tenant()) if TENANTS else EXPORT_DIR
+
+
+def _job_output_path(job_id, kind, ext):
+    folder = _job_output_folder()
+    os.makedirs(folder, exist_ok=True)
+    return os.path.abspath(os.path.join(folder, f'job-{job_id}-{kind}.{ext}'))
+
+
+def _write_job_file(path, writer):
+    # write to a temp file first so a half-written export is never downloadable
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w', newline='', encoding='utf-8') as f:
+        writer(f)
+    os.replace(tmp_path, path)
+    return path
+
+
+@job_handler('export_invoices')
+@reporting_read
+def _job_export_invoices(job_id, params):
+    return _write_job_file(_job_output_path(job_id, 'invoices', 'csv'), write_invoices_csv)
+
+
+@job_handler('export_patients')
+@reporting_read
+def _job_export_patients(job_id, params):
+    return _write_job_file(_job_output_path(job_id, 'patients', 'csv'), write_patients_csv)
+
+
+@job_handler('report')
+@reporting_read
+def _job_report(job_id, params):
+    totals = report_totals()
+    return _write_job_file(_job_output_path(job_id, 'report', 'json'), lambda f: json.dump(totals, f))
+
+
+@job_handler('mark_overdue_invoices')
+def _job_mark_overdue_invoices(job_id, params):
+    db_queries.write('invoices.mark_overdue')
+    return None
+
+
+@job_handler('prune_changelog')
+def _job_prune_changelog(job_id, params):
+    db_queries.write('changelog.prune', (CHANGELOG_RETENTION,))
+    return None
+
+
+@job_handler('archive_closed_records')
+def _job_archive_closed_records(job_id, params):
+    """Move closed appointments and paid invoices older than ARCHIVE_AFTER_MONTHS to the archive DB."""
+    cutoff = f'-{ARCHIVE_AFTER_MONTHS} months'
+    with connection_pool.connection(kind='archive') as conn:
+        conn.isolation_level = None  # one short transaction per batch so front-desk writers get the lock in between
+        try:
+            _archive_batches(conn, cutoff)
+        finally:
+            conn.isolation_level = ''
+    return None
+
+
+def _archive_batches(conn, cutoff):
+    for table, columns in ARCHIVE_COLUMNS.items():
+        cols = ', '.join(columns)
+        while True:
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                ids = [r[0] for r in conn.execute(
+                    f'SELECT id FROM main.{table} WHERE {ARCHIVE_RULES[table]} LIMIT ?',
+                    (cutoff, ARCHIVE_BATCH_SIZE))]
+                if ids:
+                    # copy before delete: if the process dies between the two files' commits the
+                    # rows sit in both, the all_* views count them once, and the next run finishes the move
+                    marks = ','.join('?' * len(ids))
+                    conn.execute(f'INSERT OR REPLACE INTO archive.{table} ({cols}) '
+                                 f'SELECT {cols} FROM main.{table} WHERE id IN ({marks})', ids)
+                    # counted from main, in main's transaction: a batch re-run after a crash is counted once
+                    conn.execute(f'INSERT INTO main.archive_totals (table_name, row_count, amount) '
+                                 f'SELECT ?, COUNT(*), TOTAL({ARCHIVE_TOTALS[table]}) FROM main.{table} '
+                                 f'WHERE id IN ({marks}) ON CONFLICT (table_name) DO UPDATE SET '
+                                 f'row_count = row_count + excluded.row_count, amount = amount + excluded.amount',
+                                 [table, *ids])
+                    # a move is not a delete: keep it out of the changelog (only this transaction sees the row)
+                    conn.execute("INSERT INTO main.changelog_suspended (reason) VALUES ('archive')")
+                    conn.execute(f'DELETE FROM main.{table} WHERE id IN ({marks})', ids)
+                    conn.execute('DELETE FROM main.changelog_suspended')
+                conn.execute('COMMIT')
+            except Exception:
+                conn.execute('ROLLBACK')
+                raise
+            if len(ids) < ARCHIVE_BATCH_SIZE:
+                break
+
+
+@job_handler('prune_exports')
+def _job_prune_exports(job_id, params):
+    """Delete export files older than EXPORT_RETENTION_DAYS (including leftover .tmp files)."""
+    cutoff = time.time() - EXPORT_RETENTION_DAYS * 86400
+    folder = _job_output_folder()
+    if os.path.isdir(folder):
+        for entry in os.scandir(folder):
+            if entry.is_file() and entry.stat().st_mtime < cutoff:
+                try:
+                    os.remove(entry.path)
+                except OSError:
+                    pass  # still being downloaded (Windows); next night
+    db_queries.write('jobs.expire_results', (f'-{EXPORT_RETENTION_DAYS} days',))
+    return None
+
+
+def enqueue_job(kind, params=None, created_by=None, dedupe_key=None, run_after=None):
+    if kind not in JOB_HANDLERS:
+        raise ValueError(f'Unknown job kind: {kind}')
+    job_id = db_queries.write('jobs.insert_dedupe' if dedupe_key else 'jobs.insert',
+                              (kind, json.dumps(params or {}), 'queued', dedupe_key, created_by, run_after)).lastrowid
+    _job_wakeup.set()
+    return job_id
+
+
+def _schedule_periodic_jobs():
+    now = time.time()
+    if now - _last_schedule_check.get(current_tenant(), 0.0) < 60:
+        return
+    _last_schedule_check[current_tenant()] = now
+    today = time.strftime('%Y-%m-%d', time.gmtime())
+    # check with reads first so an idle runner does not take the write lock every minute
+    for kind, key_template in SCHEDULED_JOBS.items():
+        dedupe_key = key_template.format(today=today)
+        if db_queries.scalar('jobs.dedupe_exists', (dedupe_key,)) is None:
+            enqueue_job(kind, dedupe_key=dedupe_key)
+    stale_after = (f'-{JOB_STALE_SECONDS} seconds',)
+    if db_queries.scalar('jobs.has_stale', stale_after) is not None:
+        db_queries.write('jobs.requeue_stale', stale_after)
+
+
+def _claim_job():
+    job_id = db_queries.scalar('jobs.next_due')
+    if job_id is None:
+        return None
+    token = uuid.uuid4().hex
+    db_queries.write('jobs.claim', (token, job_id))
+    # None if another worker claimed it between the read and the update
+    return db_queries.one('jobs.by_claim', (token,))
+
+
+@contextmanager
+def _job_heartbeat(job_id, token):
+    """Refresh the job's heartbeat_at while the block runs, so it is not requeued as stale."""
+    stop = threading.Event()
+    tenant = current_tenant()
+
+    def beat():
+        with use_tenant(tenant):
+            while not stop.wait(JOB_HEARTBEAT_SECONDS):
+                try:
+                    db_queries.write('jobs.heartbeat', (job_id, token))
+                except Exception:
+                    app.logger.exception('Heartbeat for job %s failed', job_id)
+
+    thread = threading.Thread(target=beat, name=f'job-heartbeat-{job_id}', daemon=True)
+    thread.start()
+    try:
+        yield
+    finally:
+        stop.set()
+        thread.join()
+
+
+def run_pending_job():
+    """Claim and run one due job; returns False when the queue is empty."""
+    row = _claim_job()
+    if row is None:
+        return False
+    job_id, kind, token = row.id, row.kind, row.claim_token
+    try:
+        with _job_heartbeat(job_id, token):
+            result_path = JOB_HANDLERS[kind](job_id, json.loads(row.params or '{}'))
+        db_queries.write('jobs.done', (result_path, job_id, token))
+    except Exception as e:
+        app.logger.exception('Job %s (%s) failed', job_id, kind)
+        db_queries.write('jobs.failed', (str(e), job_id, token))
+    return True
+
+
+def _job_worker_loop():
+    while True:
+        ran = False
+        for tenant in tenant_names():
+            with use_tenant(tenant):
+                try:
+                    _schedule_periodic_jobs()
+                    ran = run_pending_job() or ran
+                except Exception:
+                    app.logger.exception('Job runner error (%s)', tenant)
+        if ran:
+            continue
+        _job_wakeup.wait(JOB_POLL_SECONDS)
+        _job_wakeup.clear()
+
+
+def start_job_workers():
+    global _job_runner_pid
+    if JOB_WORKERS <= 0 or _job_runner_pid == os.getpid():
+        return
+    with _job_runner_lock:
+        if _job_runner_pid == os.getpid():
+            return
+        _job_runner_pid = os.getpid()
+        for i in range(JOB_WORKERS):
+            threading.Thread(target=_job_worker_loop, name=f'job-worker-{i}', daemon=True).start()
+
+
+@app.before_request
+def _ensure_job_workers():
+    start_job_workers()
+
+
+def start_user_job(kind):
+    return enqueue_job(kind, created_by=getattr(current_user, 'username', None))
+
+
+def _job_to_dict(row):
+    data = {
+        'id': row.id,
+        'kind': row.kind,
+        'status': row.status,
+        'error': row.error,
+        'created_at': row.created_at,
+        'started_at': row.started_at,
+        'finished_at': row.finished_at,
+        'status_url': url_for('job_status', id=row.id),
+    }
+    if row.status == 'done' and row.result_path:
+        data['download_url'] = url_for('job_download', id=row.id)
+    return data
+
+
+@app.route('/jobs/<kind>', methods=['POST'])
+@login_required
+def create_job(kind):
+    if kind not in USER_JOB_KINDS:
+        return jsonify({'error': 'Unknown job kind'}), 404
+    job_id = start_user_job(kind)
+    return jsonify({'id': job_id, 'status': 'queued', 'status_url': url_for('job_status', id=job_id)}), 202
+
+
+@app.route('/jobs/<int:id>', methods=['GET'])
+@login_required
+def job_status(id):
+    row = db_queries.one('jobs.by_id', (id,))
+    if not row:
+        return jsonify({'error': 'Job not found'}), 404
+    return jsonify(_job_to_dict(row))
+
+
+@app.route('/jobs/<int:id>/download', methods=['GET'])
+@login_required
+def job_download(id):
+    result_path = db_queries.scalar('jobs.result_path', (id,))
+    if not result_path or not os.path.exists(result_path):
+        flash('Export not available', 'danger')
+        return redirect(url_for('index'))
+    return send_file(result_path, as_attachment=True, download_name=os.path.basename(result_path))
+
+
+# ---------- Live dashboard (Server-Sent Events) ----------
+class DashboardFeed:
+    """Polls the changelog once per interval and pushes updates to every SSE client.
+
+    Only one poller runs per process, so N open dashboards cost the same handful of
+    queries per interval as one. The poller sleeps while nobody is subscribed.
+    """
+
+    def __init__(self, tenant, poll_seconds=1.0):
+        self.tenant = tenant
+        self.poll_seconds = poll_seconds
+        self._subscribers = set()
+        self._lock = threading.Lock()
+        self._poll_lock = threading.RLock()
+        self._thread = None
+        self._pid = None
+        self.last_id = None
+        self.totals = None
+        self.polls = 0
+
+    def _ensure_started(self):
+        with self._lock:
+            if self._pid == os.getpid() and self._thread is not None and self._thread.is_alive():
+                return
+            if self._pid != os.getpid():
+                self._subscribers = set()
+                self._pid = os.getpid()
+            self._thread = threading.Thread(target=self._run, name=f'dashboard-feed-{self.tenant}', daemon=True)
+            self._thread.start()
+
+    def subscribe(self):
+        self._ensure_started()
+        client = queue.Queue(maxsize=DASHBOARD_CLIENT_BUFFER)
+        with self._lock:
+            self._subscribers.add(client)
+        return client
+
+    def unsubscribe(self, client):
+        with self._lock:
+            self._subscribers.discard(client)
+            idle = not self._subscribers
+        if idle:
+            # nobody is listening, so the cursor and totals would go stale; start fresh next time
+            with self._poll_lock:
+                self.last_id = None
+                self.totals = None
+
+    def is_subscribed(self, client):
+        with self._lock:
+            return client in self._subscribers
+
+    def current_totals(self):
+        with self._poll_lock:
+            if self.totals is None:
+                self._reset_cursor()
+            return self.totals
+
+    def _reset_cursor(self):
+        self.last_id = db_queries.scalar('changelog.max_id')
+        self.totals = report_totals()
+
+    def _publish(self, event, data):
+        with self._lock:
+            clients = list(self._subscribers)
+        for client in clients:
+            try:
+                client.put_nowait((event, data))
+            except queue.Full:
+                # slow client: drop it, the browser's EventSource will reconnect
+                self.unsubscribe(client)
+
+    def _run(self):
+        _tenant_state.tenant = self.tenant
+        while True:
+            time.sleep(self.poll_seconds)
+            with self._lock:
+                idle = not self._subscribers
+            if idle:
+                continue
+            try:
+                self.poll_once()
+            except Exception:
+                app.logger.exception('Dashboard feed poll failed')
+
+    def poll_once(self):
+        with self._poll_lock:
+            self.polls += 1
+            if self.last_id is None:
+                self._reset_cursor()
+                self._publish('totals', self.totals)
+                return
+            changes = db_queries.all('changelog.since', (self.last_id, DASHBOARD_CHANGELOG_LIMIT + 1))
+            if not changes:
+                return
+            if len(changes) > DASHBOARD_CHANGELOG_LIMIT:
+                # too far behind to replay row by row; jump to the end and send fresh totals
+                self._reset_cursor()
+                self._publish('totals', self.totals)
+                return
+            self.last_id = changes[-1].id
+            new_appointments = [c.row_id for c in changes if c.table_name == 'appointments' and c.op == 'INSERT']
+            new_invoices = [c.row_id for c in changes if c.table_name == 'invoices' and c.op == 'INSERT']
+            appointment_rows = invoice_rows = []
+            if new_appointments:
+                ids = json.dumps(new_appointments[-DASHBOARD_CLIENT_BUFFER:])
+                appointment_rows = [r._asdict() for r in db_queries.all('appointments.by_ids', (ids,))]
+            if new_invoices:
+                ids = json.dumps(new_invoices[-DASHBOARD_CLIENT_BUFFER:])
+                invoice_rows = [r._asdict() for r in db_queries.all('invoices.by_ids', (ids,))]
+            self.totals = report_totals()
+        for row in appointment_rows:
+            self._publish('appointment', row)
+        for row in invoice_rows:
+            self._publish('invoice', row)
+        self._publish('totals', self.totals)
+
+
+dashboard_feeds = {}
+_dashboard_feeds_lock = threading.Lock()
+_dashboard_stream_slots = threading.BoundedSemaphore(max(0, DASHBOARD_MAX_STREAMS))
+
+
+def get_dashboard_feed():
+    """The current branch's feed; one poller per branch per process."""
+    tenant = current_tenant()
+    with _dashboard_feeds_lock:
+        feed = dashboard_feeds.get(tenant)
+        if feed is None:
+            feed = dashboard_feeds[tenant] = DashboardFeed(tenant, DASHBOARD_POLL_SECONDS)
+        return feed
+
+
+def _sse(event, data):
+    return f'event: {event}\ndata: {json.dumps(data, default=str)}\n\n'
+
+
+@app.route('/dashboard/stream', methods=['GET'])
+@login_required
+def dashboard_stream():
+    dashboard_feed = get_dashboard_feed()
+    if not _dashboard_stream_slots.acquire(blocking=False):
+        # every stream slot is taken: send the totals once and have the browser retry later,
+        # rather than tying up another thread that other requests need
+        body = f'retry: {DASHBOARD_BUSY_RETRY_MS}\n\n' + _sse('totals', dashboard_feed.current_totals())
+        return Response(body, mimetype='text/event-stream', headers={'Cache-Control': 'no-cache'})
+    client = dashboard_feed.subscribe()
+
+    def close():
+        dashboard_feed.unsubscribe(client)
+        _dashboard_stream_slots.release()
+
+    try:
+        totals = dashboard_feed.current_totals()
+    except Exception:
+        close()
+        raise
+
+    def stream():
+        yield 'retry: 3000\n\n'
+        yield _sse('totals', totals)
+        # end the stream periodically so a gunicorn thread is not pinned forever;
+        # EventSource reconnects on its own
+        deadline = time.monotonic() + DASHBOARD_STREAM_SECONDS
+        while time.monotonic() < deadline and dashboard_feed.is_subscribed(client):
+            try:
+                event, data = client.get(timeout=max(0, min(15, deadline - time.monotonic())))
+            except queue.Empty:
+                yield ': keepalive\n\n'
+                continue
+            yield _sse(event, data)
+
+    response = Response(stream(), mimetype='text/event-stream',
+                        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+    # runs when the server closes the response, even if the client left before the stream started
+    response.call_on_close(close)
+    return response
+
+
+@app.route('/history/<table>/<int:id>', methods=['GET'])
+@login_required
+def record_history(table, id):
+    if table not in HISTORY_COLUMNS:
+        return jsonify({'error': 'Unknown table'}), 404
+    rows = db_queries.all('history.for_row', (table, id))
+    return jsonify([{'op': r.op, 'data': json.loads(r.data or '{}'),
+                     'changed_by': r.changed_by, 'changed_at': r.changed_at} for r in rows])
+
+
+# ---------- Cross-branch operations ----------
+def _for_each_tenant(func):
+    """Run func() once per branch on a thread pool; returns {tenant: result}.
+
+    Each branch is its own file with its own lock, so the calls do not contend.
+    """
+    def run(tenant):
+        with use_tenant(tenant):
+            return tenant, func()
+
+    tenants = tenant_names()
+    with ThreadPoolExecutor(max_workers=max(1, min(TENANT_WORKERS, len(tenants)))) as pool:
+        return dict(pool.map(run, tenants))
+
+
+def init_all_databases():
+    """Create or upgrade every branch database concurrently."""
+    return _for_each_tenant(init_db)
+
+
+def branch_report_totals():
+    branches = _for_each_tenant(reporting_read(report_totals))
+    combined = {key: sum(totals[key] for totals in branches.values())
+                for key in ('patients', 'doctors', 'appointments', 'revenue', 'unpaid')}
+    return branches, combined
+
+
+@app.route('/report/branches', methods=['GET'])
+@login_required
+@role_required('admin')
+def branches_report():
+    branches, combined = branch_report_totals()
+    return jsonify({'branches': branches, 'total': combined})
+
+
+@app.route('/metrics/connections', methods=['GET'])
+@login_required
+@role_required('admin')
+def connection_metrics():
+    return jsonify(connection_pool.stats())
+
+
+@app.route('/metrics/write_queue', methods=['GET'])
+@login_required
+@role_required('admin')
+def write_queue_metrics():
+    return jsonify(write_queue.metrics())
+
+
+@app.route('/metrics/queries', methods=['GET'])
+@login_required
+@role_required('admin')
+def query_metrics():
+    stats = db_queries.stats()
+    if request.args.get('explain'):
+        for row in stats:
+            row['plan'] = db_queries.explain(row['name'])
+    return jsonify(stats)
+
+
+@app.route('/metrics/snapshot', methods=['GET'])
+@login_required
+@role_required('admin')
+def snapshot_metrics():
+    reporting_snapshot = get_reporting_snapshot()
+    return jsonify({
+        'enabled': REPORTING_SNAPSHOT,
+        'age_seconds': reporting_snapshot.age(),
+        'refresh_seconds': reporting_snapshot.refresh_seconds,
+        'refreshes': reporting_snapshot.refreshes,
+        'failures': reporting_snapshot.failures,
+        'last_refresh_ms': reporting_snapshot.last_refresh_ms,
+    })
 
 
 if __name__ == '__main__':
-    init_db()
+    init_all_databases()
     app.run(debug=True)